@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# Offline benchmark of vmware_cli.py against fake_vsphere.py
+#
+# For every inventory size a stand-in host is started, each scenario is run
+# --repeat times through the real command line and its wall clock time and
+# SOAP round trips per method are recorded.  Results are written as JSON so
+# a later run can be compared against them with --compare.
+#
+#   ./benchmark_vmware_cli.py --sizes 10,1000,20000 -o baseline.json
+#   ./benchmark_vmware_cli.py --sizes 10,1000,20000 --compare baseline.json
+
+import os
+import sys
+import time
+import shlex
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import fake_vsphere
+
+# Power operations on every vm get slow with large inventories, they only
+# run up to this many vms
+POWER_ALL_LIMIT = 1000
+
+# name, command line (a function of the stand-in inventory and the run
+# number), largest inventory size the scenario runs on
+SCENARIOS = [
+    ('query-vms', lambda inv, i: ['-q', '-V'], None),
+    ('query-vms-snapshot', lambda inv, i: ['-q', '-V', '--cache-max-age', '3600'], None),
+    ('query-hosts', lambda inv, i: ['-q', '-H'], None),
+    ('query-datacenters', lambda inv, i: ['-q', '-D'], None),
+    ('lookup-name', lambda inv, i: ['-q', '-V', '--name', middleVm(inv)['name']], None),
+    ('lookup-uuid', lambda inv, i: ['-q', '-V', '--uuid', middleVm(inv)['config.uuid']], None),
+    ('power-on', lambda inv, i: ['-m', '-P', '--on', '--name', middleVm(inv)['name']], None),
+    ('power-off', lambda inv, i: ['-m', '-P', '--off', '--name', middleVm(inv)['name']], None),
+    ('power-all-on', lambda inv, i: ['-m', '-P', '--on', '--all', '--parallel', '16'], POWER_ALL_LIMIT),
+    ('power-all-off', lambda inv, i: ['-m', '-P', '--off', '--all', '--parallel', '16'], POWER_ALL_LIMIT),
+    ('create', lambda inv, i: ['-c', '-V', '--name', 'bench-%d' % i, '--disk', '10',
+                               '--nic', 'VM Network', '--no-mac-check'], None),
+    ('delete', lambda inv, i: ['-d', '-V', '--name', 'bench-%d' % i], None),
+]
+
+def middleVm(inventory):
+    vms = inventory.vms()
+    return inventory.get(vms[len(vms) / 2])
+
+def median(values):
+    values = sorted(values)
+    if len(values) % 2:
+        return values[len(values) / 2]
+    return (values[len(values) / 2 - 1] + values[len(values) / 2]) / 2.0
+
+def createCertificate(directory):
+    """
+    Create a throw-away self signed certificate for the stand-in
+    """
+    cert = os.path.join(directory, 'fake.crt')
+    key = os.path.join(directory, 'fake.key')
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                               '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+                              stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
+    return cert, key
+
+def runScenario(cli, server, vsphere, name, command, repeat, home):
+    """
+    Run one scenario repeat times, returns its result record
+    """
+    times = []
+    status = 0
+    stats = None
+    env = dict(os.environ)
+    env.update({'VMWARE_USERNAME': 'root', 'VMWARE_PASSWORD': 'bench', 'HOME': home})
+    for i in range(repeat):
+        argv = cli + ['-s', '127.0.0.1:%d' % server.server_address[1]] + command(vsphere.inventory, i)
+        vsphere.resetStats()
+        start = time.time()
+        process = subprocess.Popen(argv, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        times.append(time.time() - start)
+        if process.returncode:
+            status = process.returncode
+            print >> sys.stderr, "%s failed (%d):\n%s" % (name, process.returncode, output)
+        stats = vsphere.getStats()
+    return {'times': times, 'min': min(times), 'median': median(times), 'max': max(times),
+            'status': status, 'roundTrips': stats['roundTrips'], 'calls': stats['calls'],
+            'bytesIn': stats['bytesIn'], 'bytesOut': stats['bytesOut']}
+
+def runBenchmark(options, cert, key):
+    """
+    Returns {size: {scenario: result}}
+    """
+    cli = shlex.split(options.cli)
+    wanted = options.scenarios and options.scenarios.split(',') or None
+    results = {}
+    for size in [int(s) for s in options.sizes.split(',')]:
+        vsphere = fake_vsphere.FakeVSphere(size, options.latency, options.task_duration)
+        server = fake_vsphere.startServer(vsphere, ('127.0.0.1', 0), cert, key)
+        # Snapshots and session caches must not leak between sizes
+        home = tempfile.mkdtemp()
+        try:
+            results[str(size)] = {}
+            for name, command, limit in SCENARIOS:
+                if (wanted and name not in wanted) or (limit is not None and size > limit):
+                    continue
+                result = runScenario(cli, server, vsphere, name, command, options.repeat, home)
+                results[str(size)][name] = result
+                print "%-20s %6d vms  median %7.2fs  %5d round trips" % (name, size, result['median'],
+                                                                          result['roundTrips'])
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(home, True)
+    return results
+
+def compareResults(baseline, results, threshold):
+    """
+    Print the change of every scenario against a baseline, returns the
+    number of regressions: slower by more than threshold or more round trips
+    """
+    regressions = 0
+    print "%-20s %6s %9s %9s %7s %7s %7s" % ('scenario', 'vms', 'base', 'now', 'change', 'base rt', 'now rt')
+    for size in sorted(results.keys(), key=int):
+        for name, result in sorted(results[size].items()):
+            old = baseline.get('results', {}).get(size, {}).get(name)
+            if old is None:
+                continue
+            change = (result['median'] - old['median']) / max(old['median'], 0.001)
+            flag = ''
+            if change > threshold or result['roundTrips'] > old['roundTrips']:
+                flag = 'REGRESSION'
+                regressions = regressions + 1
+            print "%-20s %6s %8.2fs %8.2fs %+6.0f%% %7d %7d %s" % (name, size, old['median'], result['median'],
+                                                                    change * 100, old['roundTrips'],
+                                                                    result['roundTrips'], flag)
+    return regressions
+
+def main():
+    parser = OptionParser(usage="%prog [options]", description='Benchmark vmware_cli.py against a local vSphere stand-in')
+    parser.add_option('--cli', dest='cli', default='jython vmware_cli.py', help='Command running vmware_cli.py (default: jython vmware_cli.py)')
+    parser.add_option('--sizes', dest='sizes', default='10,1000,20000', help='Comma separated inventory sizes (default: 10,1000,20000)')
+    parser.add_option('--scenarios', dest='scenarios', help='Comma separated scenarios to run (default: all)')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3, help='Runs per scenario (default: 3)')
+    parser.add_option('--latency', dest='latency', type='float', default=0.0, help='Seconds added to every SOAP call')
+    parser.add_option('--task-duration', dest='task_duration', type='float', default=0.1, help='Seconds until a task finishes (default: 0.1)')
+    parser.add_option('-o', '--output', dest='output', help='Write the results to this JSON file')
+    parser.add_option('--compare', dest='compare', help='Compare against a previous JSON result file')
+    parser.add_option('--threshold', dest='threshold', type='float', default=0.2, help='Slowdown reported as a regression (default: 0.2)')
+    parser.add_option('--list', dest='list', action='store_true', help='List the scenarios')
+    options, args = parser.parse_args()
+
+    if options.list:
+        for name, command, limit in SCENARIOS:
+            print name
+        sys.exit(0)
+    if options.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    certDir = tempfile.mkdtemp()
+    try:
+        cert, key = createCertificate(certDir)
+        results = runBenchmark(options, cert, key)
+    finally:
+        shutil.rmtree(certDir, True)
+
+    document = {'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'settings': {'cli': options.cli, 'repeat': options.repeat, 'latency': options.latency,
+                             'taskDuration': options.task_duration},
+                'results': results}
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(document, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    failed = [(size, name) for size in results for name in results[size] if results[size][name]['status']]
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        if compareResults(baseline, results, options.threshold):
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,727 @@
+#!/usr/bin/env python
+
+# Local stand-in for the vSphere /sdk SOAP endpoint of an ESX host
+#
+# Serves a synthetic inventory of one datacenter, one host and any number
+# of virtual machines, implementing the calls vmware_cli.py makes: service
+# content, login, PropertyCollector reads and update streams, SearchIndex
+# uuid lookups and the power, create and destroy tasks.  Every call can be
+# slowed down by a fixed latency, tasks finish after a fixed duration and
+# the number of calls per method is available from GET /stats.
+#
+# vmware_cli.py only talks https, so a certificate is needed:
+#   openssl req -x509 -newkey rsa:2048 -nodes -subj /CN=localhost -keyout fake.key -out fake.crt
+#   ./fake_vsphere.py --vms 20000 --cert fake.crt --key fake.key
+#   jython vmware_cli.py -s 127.0.0.1:8443 -u root -p x -q -V
+
+import ssl
+import time
+import random
+import threading
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+from xml.sax.saxutils import escape
+from xml.etree import cElementTree as ElementTree
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+ENVELOPE = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+            'xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+            '<soapenv:Body>%s</soapenv:Body></soapenv:Envelope>')
+
+API_VERSION = '4.1'
+
+# Methods a vm disables in each power state, as in its disabledMethod
+DISABLED_METHODS = {'poweredOff': ['PowerOffVM_Task', 'ResetVM_Task', 'SuspendVM_Task',
+                                   'ShutdownGuest', 'RebootGuest', 'StandbyGuest'],
+                    'poweredOn': ['PowerOnVM_Task', 'Destroy_Task', 'UnregisterVM']}
+
+class Mor:
+    """
+    Managed object reference
+    """
+    def __init__(self, type, val):
+        self.type = type
+        self.val = val
+
+class Enum:
+    """
+    Value of a vim enumeration type
+    """
+    def __init__(self, type, value):
+        self.type = type
+        self.value = value
+
+class Data:
+    """
+    Data object, fields is a list of (name, value) in schema order
+    """
+    def __init__(self, type, fields):
+        self.type = type
+        self.fields = fields
+
+class ArrayOf:
+    """
+    Array of data objects or references as returned in a property value
+    """
+    def __init__(self, type, items):
+        self.type = type
+        self.items = items
+
+class DateTime:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __str__(self):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.seconds))
+
+class Fault(Exception):
+    """
+    Raised by call handlers, sent back as a SOAP fault
+    """
+    def __init__(self, type, message):
+        Exception.__init__(self, message)
+        self.type = type
+
+def toXml(tag, value, typed=False):
+    """
+    Serialize a value as element tag, typed adds the xsi:type attribute
+    needed by untyped (xsd:anyType) fields like property values (val)
+    """
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ''.join([toXml(tag, v, typed) for v in value])
+    if isinstance(value, Mor):
+        return '<%s type="%s">%s</%s>' % (tag, value.type, escape(value.val), tag)
+    if isinstance(value, Data):
+        return '<%s xsi:type="%s">%s</%s>' % (tag, value.type,
+                                              ''.join([toXml(n, v, n == 'val') for n, v in value.fields]), tag)
+    if isinstance(value, ArrayOf):
+        itemTag = value.type
+        if itemTag == 'ManagedObjectReference':
+            return '<%s xsi:type="ArrayOfManagedObjectReference">%s</%s>' % (
+                tag, ''.join([toXml(itemTag, v) for v in value.items]), tag)
+        if itemTag == 'string':
+            return '<%s xsi:type="ArrayOfString">%s</%s>' % (
+                tag, ''.join([toXml(itemTag, v) for v in value.items]), tag)
+        return '<%s xsi:type="ArrayOf%s">%s</%s>' % (tag, itemTag,
+                                                     ''.join([toXml(itemTag, v, True) for v in value.items]), tag)
+    if isinstance(value, Enum):
+        text, xsiType = value.value, value.type
+    elif isinstance(value, bool):
+        text, xsiType = value and 'true' or 'false', 'xsd:boolean'
+    elif isinstance(value, long):
+        text, xsiType = str(value), 'xsd:long'
+    elif isinstance(value, int):
+        text, xsiType = str(value), 'xsd:int'
+    elif isinstance(value, DateTime):
+        text, xsiType = str(value), 'xsd:dateTime'
+    else:
+        text, xsiType = value, 'xsd:string'
+    if typed:
+        return '<%s xsi:type="%s">%s</%s>' % (tag, xsiType, escape(text), tag)
+    return '<%s>%s</%s>' % (tag, escape(text), tag)
+
+def localName(tag):
+    return tag.split('}')[-1]
+
+def child(el, name):
+    for c in el:
+        if localName(c.tag) == name:
+            return c
+    return None
+
+def children(el, name):
+    return [c for c in el if localName(c.tag) == name]
+
+def childText(el, name, default=None):
+    c = child(el, name)
+    if c is None or c.text is None:
+        return default
+    return c.text
+
+def parseMor(el):
+    return Mor(el.get('type'), el.text)
+
+def morKey(mor):
+    return "%s:%s" % (mor.type, mor.val)
+
+class Inventory:
+    """
+    The managed objects of the fake host, each a dict of property path
+    to value, plus the tasks and property collectors in flight
+    """
+    def __init__(self, vmCount, taskDuration):
+        self.lock = threading.RLock()
+        self.taskDuration = taskDuration
+        self.objects = {}
+        self.order = []
+        self.ids = 0
+        self.tasks = []
+        self.collectors = {}
+        self.filters = {}
+
+        self.rootFolder = self.add('Folder', 'ha-folder-root', {'name': 'ha-folder-root'})
+        self.vmFolder = self.add('Folder', 'ha-folder-vm', {'name': 'vm'})
+        self.hostFolder = self.add('Folder', 'ha-folder-host', {'name': 'host'})
+        self.datacenter = self.add('Datacenter', 'ha-datacenter',
+                                   {'name': 'ha-datacenter', 'vmFolder': self.vmFolder,
+                                    'hostFolder': self.hostFolder})
+        self.pool = self.add('ResourcePool', 'ha-root-pool', {'name': 'Resources'})
+        self.network = self.add('Network', 'HaNetwork-VM Network', {'name': 'VM Network'})
+        self.autoStartManager = self.add('HostAutoStartManager', 'ha-autostart-mgr', {})
+        self.host = self.add('HostSystem', 'ha-host', {
+            'name': 'esx.fake.local',
+            'overallStatus': Enum('ManagedEntityStatus', 'green'),
+            'configManager.autoStartManager': self.autoStartManager,
+            'config.network.portgroup': ArrayOf('HostPortGroup', [Data('HostPortGroup', [
+                ('key', 'key-vim.host.PortGroup-VM Network'),
+                ('spec', Data('HostPortGroupSpec', [('name', 'VM Network'), ('vlanId', 0),
+                                                    ('vswitchName', 'vSwitch0'),
+                                                    ('policy', Data('HostNetworkPolicy', []))]))])]),
+            'hardware.systemInfo': Data('HostSystemInfo', [('vendor', 'Fake'), ('model', 'Stand-in'),
+                                                           ('uuid', '00000000-0000-0000-0000-000000000001')]),
+            'hardware.biosInfo': Data('HostBIOSInfo', [('biosVersion', '1.0'),
+                                                       ('releaseDate', DateTime(0))]),
+            'hardware.cpuPkg': ArrayOf('HostCpuPackage', [Data('HostCpuPackage', [
+                ('index', 0), ('vendor', 'intel'), ('hz', 2400000000L), ('busHz', 133000000L),
+                ('description', 'Fake CPU'), ('threadId', [0, 1, 2, 3])])]),
+            'hardware.cpuInfo': Data('HostCpuInfo', [('numCpuPackages', 1), ('numCpuCores', 4),
+                                                     ('numCpuThreads', 4), ('hz', 2400000000L)]),
+            'hardware.memorySize': 68719476736L})
+        self.sessionManager = self.add('SessionManager', 'ha-sessionmgr', {})
+        self.searchIndex = self.add('SearchIndex', 'ha-searchindex', {})
+        self.propertyCollector = self.add('PropertyCollector', 'ha-property-collector', {})
+        self.collectors[self.propertyCollector.val] = []
+
+        for i in range(vmCount):
+            self.addVm("vm%05d" % (i + 1), 2, 2048, "00:50:56:%02x:%02x:%02x" % (
+                (i >> 16) & 0x3f, (i >> 8) & 0xff, i & 0xff))
+        self.updateAutoStart()
+
+    def nextId(self, prefix):
+        self.ids = self.ids + 1
+        return "%s-%d" % (prefix, self.ids)
+
+    def add(self, type, val, props):
+        mor = Mor(type, val)
+        self.objects[morKey(mor)] = props
+        self.order.append(morKey(mor))
+        return mor
+
+    def remove(self, mor):
+        key = morKey(mor)
+        if key in self.objects:
+            del self.objects[key]
+            self.order.remove(key)
+
+    def get(self, mor):
+        obj = self.objects.get(morKey(mor))
+        if obj is None:
+            raise Fault('ManagedObjectNotFound', 'The object %s has already been deleted' % mor.val)
+        return obj
+
+    def addVm(self, name, numCPU, memoryMB, mac, annotation='', guestFullName='Red Hat Enterprise Linux 5 (64-bit)'):
+        nic = Data('VirtualE1000', [
+            ('key', 4000),
+            ('deviceInfo', Data('Description', [('label', 'Network adapter 1'), ('summary', 'VM Network')])),
+            ('backing', Data('VirtualEthernetCardNetworkBackingInfo', [('deviceName', 'VM Network')])),
+            ('addressType', mac and 'manual' or 'generated'),
+            ('macAddress', mac)])
+        return self.add('VirtualMachine', self.nextId('vm'), {
+            'name': name,
+            'config.uuid': "564d%04x-%04x-%04x-%04x-%012x" % tuple([random.getrandbits(16) for i in range(4)] +
+                                                                   [random.getrandbits(48)]),
+            'config.guestFullName': guestFullName,
+            'config.hardware.numCPU': numCPU,
+            'config.hardware.memoryMB': memoryMB,
+            'config.annotation': annotation,
+            'config.hardware.device': ArrayOf('VirtualDevice', [nic]),
+            'runtime.powerState': Enum('VirtualMachinePowerState', 'poweredOff'),
+            'disabledMethod': ArrayOf('string', DISABLED_METHODS['poweredOff'])})
+
+    def vms(self):
+        return [Mor('VirtualMachine', key.split(':', 1)[1]) for key in self.order
+                if key.startswith('VirtualMachine:')]
+
+    def updateAutoStart(self):
+        """
+        Give the first ten vms an autostart order
+        """
+        powerInfo = [Data('AutoStartPowerInfo', [
+            ('key', vm), ('startOrder', i + 1), ('startDelay', -1),
+            ('waitForHeartbeat', Enum('AutoStartWaitHeartbeatSetting', 'systemDefault')),
+            ('startAction', 'powerOn'), ('stopDelay', -1), ('stopAction', 'systemDefault')])
+                     for i, vm in enumerate(self.vms()[:10])]
+        defaults = Data('AutoStartDefaults', [('enabled', True), ('startDelay', 120), ('stopDelay', 120),
+                                              ('waitForHeartbeat', False), ('stopAction', 'PowerOff')])
+        self.objects[morKey(self.autoStartManager)].update({
+            'config': Data('HostAutoStartManagerConfig', [('defaults', defaults), ('powerInfo', powerInfo)]),
+            'config.powerInfo': ArrayOf('AutoStartPowerInfo', powerInfo)})
+
+    def addTask(self, entity, action, descriptionId):
+        """
+        Start a task that runs action() once taskDuration has elapsed
+        """
+        mor = self.add('Task', self.nextId('haTask'), {})
+        task = {'mor': mor, 'entity': entity, 'action': action, 'descriptionId': descriptionId,
+                'queued': time.time(), 'due': time.time() + self.taskDuration}
+        self.setTaskInfo(task, 'running', None, None)
+        self.tasks.append(task)
+        return mor
+
+    def setTaskInfo(self, task, state, error, result):
+        props = self.objects[morKey(task['mor'])]
+        props['info.state'] = Enum('TaskInfoState', state)
+        props['info.error'] = error
+        props['info.result'] = result
+        props['info'] = Data('TaskInfo', [
+            ('key', task['mor'].val), ('task', task['mor']), ('descriptionId', task['descriptionId']),
+            ('entity', task['entity']), ('state', Enum('TaskInfoState', state)), ('cancelled', False),
+            ('cancelable', False), ('error', error), ('result', result),
+            ('queueTime', DateTime(task['queued']))])
+
+    def runTasks(self):
+        """
+        Complete every task that is due
+        """
+        now = time.time()
+        for task in [t for t in self.tasks if t['due'] <= now]:
+            self.tasks.remove(task)
+            try:
+                self.setTaskInfo(task, 'success', None, task['action']())
+            except Fault, fault:
+                self.setTaskInfo(task, 'error', Data('LocalizedMethodFault', [
+                    ('fault', Data(fault.type, [])), ('localizedMessage', str(fault))]), None)
+
+    def traverse(self, objectSpecs):
+        """
+        Resolve object specs to object keys.  Any traversal spec is taken
+        as a full inventory traversal from the starting object.
+        """
+        keys = []
+        for spec in objectSpecs:
+            key = morKey(spec['obj'])
+            if spec['traverse']:
+                keys.extend([k for k in self.order if k != key or not spec['skip']])
+            elif not spec['skip'] and key in self.objects:
+                keys.append(key)
+        return keys
+
+    def collect(self, filterSpec):
+        """
+        Return {object key: {path: value}} for a parsed PropertyFilterSpec
+        """
+        result = {}
+        for key in self.traverse(filterSpec['objectSet']):
+            type = key.split(':', 1)[0]
+            props = self.objects.get(key)
+            if props is None:
+                continue
+            for propSpec in filterSpec['propSet']:
+                if propSpec['type'] != type:
+                    continue
+                paths = propSpec['all'] and props.keys() or propSpec['pathSet']
+                values = result.setdefault(key, {})
+                for path in paths:
+                    if props.get(path) is not None:
+                        values[path] = props[path]
+        return result
+
+def userSession(userName):
+    now = DateTime(time.time())
+    return Data('UserSession', [('key', 'fake-session'), ('userName', userName), ('fullName', userName),
+                                ('loginTime', now), ('lastActiveTime', now), ('locale', 'en'),
+                                ('messageLocale', 'en')])
+
+def parseFilterSpec(el):
+    spec = {'propSet': [], 'objectSet': []}
+    for p in children(el, 'propSet'):
+        spec['propSet'].append({'type': childText(p, 'type'),
+                                'all': childText(p, 'all', 'false') == 'true',
+                                'pathSet': [c.text for c in children(p, 'pathSet')]})
+    for o in children(el, 'objectSet'):
+        spec['objectSet'].append({'obj': parseMor(child(o, 'obj')),
+                                  'skip': childText(o, 'skip', 'false') == 'true',
+                                  'traverse': len(children(o, 'selectSet')) > 0})
+    return spec
+
+def objectContent(key, values):
+    type, val = key.split(':', 1)
+    return Data('ObjectContent', [('obj', Mor(type, val)),
+                                  ('propSet', [Data('DynamicProperty', [('name', path), ('val', values[path])])
+                                               for path in sorted(values.keys())])])
+
+class FakeVSphere:
+    """
+    Implementation of the SOAP methods, one method per vim call taking
+    the request element and returning the returnval or None
+    """
+    def __init__(self, vmCount=100, latency=0.0, taskDuration=1.0):
+        self.inventory = Inventory(vmCount, taskDuration)
+        self.latency = latency
+        self.statsLock = threading.Lock()
+        self.resetStats()
+
+    def resetStats(self):
+        self.statsLock.acquire()
+        try:
+            self.stats = {'calls': {}, 'seconds': {}, 'bytesIn': 0, 'bytesOut': 0}
+        finally:
+            self.statsLock.release()
+
+    def getStats(self, reset=False):
+        self.statsLock.acquire()
+        try:
+            stats = self.stats
+            stats['roundTrips'] = sum(stats['calls'].values())
+            if reset:
+                self.stats = {'calls': {}, 'seconds': {}, 'bytesIn': 0, 'bytesOut': 0}
+            return stats
+        finally:
+            self.statsLock.release()
+
+    def recordCall(self, method, seconds, bytesIn, bytesOut):
+        self.statsLock.acquire()
+        try:
+            self.stats['calls'][method] = self.stats['calls'].get(method, 0) + 1
+            self.stats['seconds'][method] = self.stats['seconds'].get(method, 0.0) + seconds
+            self.stats['bytesIn'] = self.stats['bytesIn'] + bytesIn
+            self.stats['bytesOut'] = self.stats['bytesOut'] + bytesOut
+        finally:
+            self.statsLock.release()
+
+    def handle(self, body):
+        """
+        Dispatch a SOAP request, returns (http status, response xml, method)
+        """
+        try:
+            call = list(child(ElementTree.fromstring(body), 'Body'))[0]
+        except (SyntaxError, IndexError, TypeError):
+            return 500, self.fault(Fault('InvalidRequest', 'Unable to parse request')), 'invalid'
+        method = localName(call.tag)
+
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, 'do' + method, None)
+        try:
+            if handler is None:
+                raise Fault('NotImplemented', '%s is not implemented by the stand-in' % method)
+            if method != 'WaitForUpdatesEx':
+                self.inventory.lock.acquire()
+                try:
+                    self.inventory.runTasks()
+                    returnval = handler(call)
+                finally:
+                    self.inventory.lock.release()
+            else:
+                returnval = handler(call)
+        except Fault, fault:
+            return 500, self.fault(fault), method
+
+        if isinstance(returnval, list):
+            content = ''.join([toXml('returnval', v) for v in returnval])
+        else:
+            content = toXml('returnval', returnval)
+        return 200, ENVELOPE % ('<%sResponse xmlns="urn:vim25">%s</%sResponse>' % (method, content, method)), method
+
+    def fault(self, fault):
+        return ENVELOPE % ('<soapenv:Fault><faultcode>ServerFaultCode</faultcode><faultstring>%s</faultstring>'
+                           '<detail><%sFault xmlns="urn:vim25" xsi:type="%s"/></detail></soapenv:Fault>' %
+                           (escape(str(fault)), fault.type, fault.type))
+
+    # Service instance and sessions
+
+    def doRetrieveServiceContent(self, call):
+        inv = self.inventory
+        return Data('ServiceContent', [
+            ('rootFolder', inv.rootFolder), ('propertyCollector', inv.propertyCollector),
+            ('about', Data('AboutInfo', [
+                ('name', 'VMware ESX'), ('fullName', 'VMware ESX 4.1.0 build-260247 (stand-in)'),
+                ('vendor', 'VMware, Inc.'), ('version', '4.1.0'), ('build', '260247'),
+                ('localeVersion', 'INTL'), ('localeBuild', '000'), ('osType', 'vmnix-x86'),
+                ('productLineId', 'esx'), ('apiType', 'HostAgent'), ('apiVersion', API_VERSION)])),
+            ('sessionManager', inv.sessionManager), ('searchIndex', inv.searchIndex)])
+
+    def doLogin(self, call):
+        session = userSession(childText(call, 'userName', 'root'))
+        self.inventory.get(self.inventory.sessionManager)['currentSession'] = session
+        return session
+
+    def doLogout(self, call):
+        return None
+
+    def doCurrentTime(self, call):
+        return DateTime(time.time())
+
+    # PropertyCollector
+
+    def doRetrieveProperties(self, call):
+        inv = self.inventory
+        if parseMor(child(call, '_this')).val not in inv.collectors:
+            raise Fault('ManagedObjectNotFound', 'Unknown property collector')
+        result = {}
+        for el in children(call, 'specSet'):
+            for key, values in inv.collect(parseFilterSpec(el)).items():
+                result.setdefault(key, {}).update(values)
+        return [objectContent(key, result[key]) for key in inv.order if key in result]
+
+    def doCreatePropertyCollector(self, call):
+        inv = self.inventory
+        mor = inv.add('PropertyCollector', inv.nextId('session[fake]propertyCollector'), {})
+        inv.collectors[mor.val] = []
+        return mor
+
+    def doDestroyPropertyCollector(self, call):
+        inv = self.inventory
+        mor = parseMor(child(call, '_this'))
+        for f in inv.collectors.pop(mor.val, []):
+            inv.filters.pop(f, None)
+        inv.remove(mor)
+        return None
+
+    def doCreateFilter(self, call):
+        inv = self.inventory
+        collector = parseMor(child(call, '_this'))
+        if collector.val not in inv.collectors:
+            raise Fault('ManagedObjectNotFound', 'Unknown property collector')
+        mor = inv.add('PropertyFilter', inv.nextId('session[fake]filter'), {})
+        inv.filters[mor.val] = {'mor': mor, 'spec': parseFilterSpec(child(call, 'spec')), 'reported': {}}
+        inv.collectors[collector.val].append(mor.val)
+        return mor
+
+    def doDestroyPropertyFilter(self, call):
+        inv = self.inventory
+        mor = parseMor(child(call, '_this'))
+        inv.filters.pop(mor.val, None)
+        for filters in inv.collectors.values():
+            if mor.val in filters:
+                filters.remove(mor.val)
+        inv.remove(mor)
+        return None
+
+    def pendingUpdates(self, collector, version):
+        """
+        Diff every filter of a collector against what it last reported,
+        returns an UpdateSet or None when nothing changed
+        """
+        inv = self.inventory
+        if collector.val not in inv.collectors:
+            raise Fault('ManagedObjectNotFound', 'Unknown property collector')
+        filterUpdates = []
+        for f in [inv.filters[name] for name in inv.collectors[collector.val]]:
+            if not version:
+                f['reported'] = {}
+            current = {}
+            for key, values in inv.collect(f['spec']).items():
+                current[key] = dict([(path, toXml('val', v, True)) for path, v in values.items()])
+                current[key]['_values'] = values
+            objectUpdates = []
+            for key in inv.order:
+                if key not in current:
+                    continue
+                old = f['reported'].get(key)
+                values = current[key]['_values']
+                changed = [path for path in values if old is None or old.get(path) != current[key][path]]
+                if old is not None:
+                    changed.extend([path for path in old if path != '_values' and path not in values])
+                if changed:
+                    type, val = key.split(':', 1)
+                    objectUpdates.append(Data('ObjectUpdate', [
+                        ('kind', Enum('ObjectUpdateKind', old is None and 'enter' or 'modify')),
+                        ('obj', Mor(type, val)),
+                        ('changeSet', [Data('PropertyChange', [('name', path),
+                                                               ('op', Enum('PropertyChangeOp', 'assign')),
+                                                               ('val', values.get(path))])
+                                       for path in sorted(changed)])]))
+            for key in f['reported'].keys():
+                if key not in current:
+                    type, val = key.split(':', 1)
+                    objectUpdates.append(Data('ObjectUpdate', [('kind', Enum('ObjectUpdateKind', 'leave')),
+                                                               ('obj', Mor(type, val))]))
+            f['reported'] = current
+            if objectUpdates:
+                filterUpdates.append(Data('PropertyFilterUpdate', [('filter', f['mor']),
+                                                                   ('objectSet', objectUpdates)]))
+        if not filterUpdates:
+            return None
+        return Data('UpdateSet', [('version', inv.nextId('v')), ('filterSet', filterUpdates)])
+
+    def doCheckForUpdates(self, call):
+        return self.pendingUpdates(parseMor(child(call, '_this')), childText(call, 'version', ''))
+
+    def doWaitForUpdatesEx(self, call):
+        inv = self.inventory
+        collector = parseMor(child(call, '_this'))
+        version = childText(call, 'version', '')
+        options = child(call, 'options')
+        maxWait = None
+        if options is not None and childText(options, 'maxWaitSeconds') is not None:
+            maxWait = int(childText(options, 'maxWaitSeconds'))
+        deadline = maxWait is not None and time.time() + maxWait or None
+        while True:
+            inv.lock.acquire()
+            try:
+                inv.runTasks()
+                updates = self.pendingUpdates(collector, version)
+            finally:
+                inv.lock.release()
+            if updates is not None or (deadline is not None and time.time() >= deadline):
+                return updates
+            time.sleep(0.02)
+
+    # SearchIndex
+
+    def doFindByUuid(self, call):
+        inv = self.inventory
+        uuid = childText(call, 'uuid', '').lower()
+        for vm in inv.vms():
+            if inv.get(vm)['config.uuid'] == uuid:
+                return vm
+        return None
+
+    # Tasks
+
+    def checkEnabled(self, mor, method):
+        """
+        Fail like the host does when a vm has method disabled
+        """
+        disabled = self.inventory.get(mor).get('disabledMethod')
+        if disabled is not None and method in disabled.items:
+            raise Fault('InvalidState', 'The operation %s is not allowed in the current state' % method)
+
+    def powerTask(self, call, state, descriptionId):
+        inv = self.inventory
+        vm = parseMor(child(call, '_this'))
+        self.checkEnabled(vm, localName(call.tag))
+
+        def action():
+            props = inv.get(vm)
+            props['runtime.powerState'] = Enum('VirtualMachinePowerState', state)
+            props['disabledMethod'] = ArrayOf('string', DISABLED_METHODS[state])
+            return None
+        return inv.addTask(vm, action, descriptionId)
+
+    def doPowerOnVM_Task(self, call):
+        return self.powerTask(call, 'poweredOn', 'VirtualMachine.powerOn')
+
+    def doPowerOffVM_Task(self, call):
+        return self.powerTask(call, 'poweredOff', 'VirtualMachine.powerOff')
+
+    def doResetVM_Task(self, call):
+        return self.powerTask(call, 'poweredOn', 'VirtualMachine.reset')
+
+    def doDestroy_Task(self, call):
+        inv = self.inventory
+        mor = parseMor(child(call, '_this'))
+        self.checkEnabled(mor, 'Destroy_Task')
+
+        def action():
+            inv.get(mor)
+            inv.remove(mor)
+            inv.updateAutoStart()
+            return None
+        return inv.addTask(mor, action, 'VirtualMachine.destroy')
+
+    def doCreateVM_Task(self, call):
+        inv = self.inventory
+        config = child(call, 'config')
+        name = childText(config, 'name')
+        if not name:
+            raise Fault('InvalidArgument', 'A specified parameter was not correct: config.name')
+        mac = None
+        for change in children(config, 'deviceChange'):
+            device = child(change, 'device')
+            if device is not None and childText(device, 'macAddress'):
+                mac = childText(device, 'macAddress')
+                break
+
+        def action():
+            return inv.addVm(name, int(childText(config, 'numCPUs', '1')), int(childText(config, 'memoryMB', '256')),
+                             mac, childText(config, 'annotation', ''), childText(config, 'guestId', 'otherGuest'))
+        return inv.addTask(inv.vmFolder, action, 'Folder.createVm')
+
+class SoapRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    POST /sdk runs a SOAP call, GET /stats returns the call counters as
+    JSON (reset with ?reset=1)
+    """
+    def do_POST(self):
+        if self.path.rstrip('/') != '/sdk':
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        start = time.time()
+        status, response, method = self.server.vsphere.handle(body)
+        self.server.vsphere.recordCall(method, time.time() - start, len(body), len(response))
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(response)))
+        if method == 'Login':
+            self.send_header('Set-Cookie', 'vmware_soap_session="fake-session"; Path=/; HttpOnly')
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_GET(self):
+        if not self.path.startswith('/stats'):
+            self.send_error(404)
+            return
+        response = json.dumps(self.server.vsphere.getStats(reset=self.path.endswith('reset=1')))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+class SoapServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def startServer(vsphere, address, certFile, keyFile):
+    """
+    Serve a FakeVSphere over https in a background thread, returns the
+    server, its port is server.server_address[1]
+    """
+    host, port = address
+    server = SoapServer((host, port), SoapRequestHandler)
+    server.vsphere = vsphere
+    server.socket = ssl.wrap_socket(server.socket, certfile=certFile, keyfile=keyFile, server_side=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+def main():
+    parser = OptionParser(usage="%prog [options]", description='Local stand-in for the vSphere /sdk endpoint')
+    parser.add_option('-l', '--listen', dest='listen', default='127.0.0.1:8443', help='Listen address (default: 127.0.0.1:8443)')
+    parser.add_option('-n', '--vms', dest='vms', type='int', default=100, help='Number of virtual machines (default: 100)')
+    parser.add_option('--latency', dest='latency', type='float', default=0.0, help='Seconds added to every call')
+    parser.add_option('--task-duration', dest='task_duration', type='float', default=1.0, help='Seconds until a task finishes (default: 1)')
+    parser.add_option('--cert', dest='cert', help='PEM certificate')
+    parser.add_option('--key', dest='key', help='PEM private key')
+    options, args = parser.parse_args()
+    if not options.cert:
+        parser.error("--cert is required")
+
+    host, port = options.listen.rsplit(':', 1)
+    server = startServer(FakeVSphere(options.vms, options.latency, options.task_duration),
+                         (host, int(port)), options.cert, options.key or options.cert)
+    print "Serving %d vms on https://%s/sdk" % (options.vms, options.listen)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
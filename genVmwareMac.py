@@ -3,7 +3,27 @@
 # Generate mac addresses in the range
 # 00:50:56:00:00:00 - 00:50:56:3F:FF:FF
 
+import os
+import sys
+import array
+import fcntl
 import random
+import heapq
+import re
+import struct
+from optparse import OptionParser
+
+# Number of addresses in the manual VMware range and the size of the
+# bitmap tracking them (one bit per address, 512 KB)
+POOL_SIZE = 0x400000
+BITMAP_SIZE = POOL_SIZE / 8
+
+# The state file starts with a header holding the allocation cursor, so a
+# nearly full pool is not rescanned from the start by every run.  Files
+# without it (bitmap only) are still read.
+HEADER_MAGIC = 'VMWMAC1\n'
+HEADER_FORMAT = '>8sI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
 
 def random_mac():
     """
@@ -21,12 +41,213 @@ def random_mac():
 
 def mac_range():
     """
-    Generate a list of all the macs
+    Generate all the macs in the range, one at a time
+    """
+    for a in range(0x00, 0x40):
+        for b in range(0x00, 0x100):
+            for c in range(0x00, 0x100):
+                yield "00:50:56:%0.2x:%0.2x:%0.2x" % (a,b,c)
+
+def mac_to_index(mac):
+    """
+    Return the position of a mac address in the pool
+    """
+    octets = [int(x, 16) for x in mac.split(':')]
+    if len(octets) != 6 or octets[:3] != [0x00, 0x50, 0x56]:
+        raise ValueError("%s is not a VMware mac address" % mac)
+    index = (octets[3] << 16) | (octets[4] << 8) | octets[5]
+    if index >= POOL_SIZE:
+        raise ValueError("%s is outside 00:50:56:00:00:00 - 00:50:56:3F:FF:FF" % mac)
+    return index
+
+def index_to_mac(index):
+    """
+    Return the mac address at a position in the pool
+    """
+    return "00:50:56:%0.2x:%0.2x:%0.2x" % ((index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
+
+class MacPool:
+    """
+    Bitmap of the allocated addresses of the VMware manual mac range.
+    Fresh addresses come from a frontier cursor that only moves forward
+    over full bytes, so handing them out in order is O(1) amortized.
+    Released addresses behind the frontier go to a heap and are handed
+    out again first, lowest first, in O(log n); lookups are O(1).
     """
-    mac_list = []
-    for a in range(0x00, 0x3f):
-        for b in range(0x00, 0xff):
-            for c in range(0x00, 0xff):
-                mac_list.append("00:50:56:%0.2x:%0.2x:%0.2x" % (a,b,c))
+    def __init__(self, bitmap=None):
+        if bitmap is None:
+            bitmap = array.array('B', [0]) * BITMAP_SIZE
+        self.bitmap = bitmap
+        self.cursor = 0
+        self.free = []
+
+    def find_free(self):
+        """
+        Rebuild the heap of free addresses behind the frontier
+        """
+        self.free = []
+        data = self.bitmap[:self.cursor].tostring()
+        for match in re.finditer('[^\xff]', data):
+            pos = match.start()
+            byte = self.bitmap[pos]
+            for bit in range(8):
+                if not byte & (1 << bit):
+                    self.free.append((pos << 3) | bit)
+        heapq.heapify(self.free)
+
+    def is_allocated(self, mac):
+        index = mac_to_index(mac)
+        return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+    def reserve(self, mac):
+        """
+        Mark an address as used, returns False if it already was
+        """
+        index = mac_to_index(mac)
+        if self.bitmap[index >> 3] & (1 << (index & 7)):
+            return False
+        self.bitmap[index >> 3] |= (1 << (index & 7))
+        return True
+
+    def release(self, mac):
+        index = mac_to_index(mac)
+        if not self.bitmap[index >> 3] & (1 << (index & 7)):
+            return
+        self.bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xff
+        if (index >> 3) < self.cursor:
+            heapq.heappush(self.free, index)
+
+    def allocate(self):
+        """
+        Return a released address, or else the first free one at the
+        frontier, and mark it as used
+        """
+        while self.free:
+            index = heapq.heappop(self.free)
+            # Skip addresses reserved again since they were released
+            if not self.bitmap[index >> 3] & (1 << (index & 7)):
+                self.bitmap[index >> 3] |= (1 << (index & 7))
+                return index_to_mac(index)
+        for pos in xrange(self.cursor, BITMAP_SIZE):
+            byte = self.bitmap[pos]
+            if byte != 0xff:
+                self.cursor = pos
+                bit = 0
+                while byte & (1 << bit):
+                    bit = bit + 1
+                self.bitmap[pos] = byte | (1 << bit)
+                return index_to_mac((pos << 3) | bit)
+        self.cursor = BITMAP_SIZE
+        raise ValueError("mac address pool exhausted")
+
+    def allocate_many(self, count):
+        return [self.allocate() for i in range(count)]
+
+    def load(self, f):
+        data = f.read()
+        cursor = 0
+        if len(data) == HEADER_SIZE + BITMAP_SIZE:
+            magic, cursor = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+            if magic != HEADER_MAGIC:
+                raise ValueError("mac pool state has an unknown header")
+            data = data[HEADER_SIZE:]
+        bitmap = array.array('B')
+        bitmap.fromstring(data)
+        if len(bitmap) != BITMAP_SIZE:
+            raise ValueError("mac pool state has the wrong size")
+        self.bitmap = bitmap
+        self.cursor = min(cursor, BITMAP_SIZE)
+        self.find_free()
+
+    def dump(self, f):
+        f.write(struct.pack(HEADER_FORMAT, HEADER_MAGIC, self.cursor))
+        f.write(self.bitmap.tostring())
+
+def open_pool(path, callback):
+    """
+    Run callback(pool) on the pool stored in path while holding an
+    exclusive lock, then write the pool back atomically.  Concurrent
+    provisioning runs using the same file never hand out the same mac.
+    """
+    lock = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        pool = MacPool()
+        if os.path.exists(path):
+            f = open(path, 'rb')
+            try:
+                pool.load(f)
+            finally:
+                f.close()
+
+        result = callback(pool)
+
+        tmp = "%s.%d" % (path, os.getpid())
+        f = open(tmp, 'wb')
+        try:
+            pool.dump(f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, path)
+        return result
+    finally:
+        lock.close()
+
+def allocate_macs(path, count):
+    """
+    Allocate count addresses from the pool stored in path
+    """
+    return open_pool(path, lambda pool: pool.allocate_many(count))
+
+def release_macs(path, macs):
+    """
+    Return addresses to the pool stored in path
+    """
+    def release(pool):
+        for mac in macs:
+            pool.release(mac)
+    open_pool(path, release)
+
+def reserve_macs(path, macs):
+    """
+    Mark addresses already in use, returns the ones that were taken
+    """
+    def reserve(pool):
+        return [mac for mac in macs if not pool.reserve(mac)]
+    return open_pool(path, reserve)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--state', dest='state', help='Allocate from the pool kept in this file')
+    parser.add_option('-n', '--count', dest='count', type='int', default=1,
+                      help='Number of addresses to allocate (default: 1)')
+    parser.add_option('--release', dest='release', action='append', metavar='<mac>',
+                      help='Return an address to the pool')
+    parser.add_option('--reserve', dest='reserve', action='append', metavar='<mac>',
+                      help='Mark an address already in use')
+    options, args = parser.parse_args()
+    if args:
+        parser.error("unexpected arguments %s, repeat --release or --reserve for every address"
+                     % ' '.join(args))
+
+    if options.state is None:
+        if options.release or options.reserve:
+            parser.error("--release and --reserve need --state")
+        for i in range(options.count):
+            print random_mac()
+        sys.exit(0)
 
-print random_mac()
+    try:
+        if options.release:
+            release_macs(options.state, options.release)
+        elif options.reserve:
+            for mac in reserve_macs(options.state, options.reserve):
+                print "%s was already allocated" % mac
+        else:
+            for mac in allocate_macs(options.state, options.count):
+                print mac
+    except ValueError, reason:
+        print reason
+        sys.exit(1)
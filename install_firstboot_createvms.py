@@ -3,6 +3,8 @@ Create VMware images on firstboot based on data in Cobbler
 """
 
 import distutils.sysconfig
+import threading
+import Queue
 import utils
 import sys
 
@@ -10,6 +12,12 @@ plib = distutils.sysconfig.get_python_lib()
 mod_path="%s/cobbler" % plib
 sys.path.insert(0, mod_path)
 
+from cexceptions import CX
+
+# Number of guests created at the same time on one host, overridable
+# per system with ks_meta vm_parallel=<n>
+DEFAULT_PARALLEL = 4
+
 def register():
     # this pure python trigger acts as if it were a legacy shell-trigger, but is much faster.
     # the return of this method indicates the trigger type
@@ -35,14 +43,50 @@ def run(api,args,logger):
         raise CX("failure looking up target")
 
     if target['ks_meta']['vms']:
-        for vm in target['ks_meta']['vms'].split(','):
+        vms = [vm for vm in target['ks_meta']['vms'].split(',') if vm]
+        try:
+            parallel = int(target['ks_meta'].get('vm_parallel', DEFAULT_PARALLEL))
+        except ValueError:
+            parallel = DEFAULT_PARALLEL
+        results = createVms(target, vms, max(1, parallel), logger)
+
+        failed = [vm for vm in vms if results.get(vm) != 0]
+        for vm in vms:
+            if vm in failed:
+                logger.error("virtual guest %s failed (%s)" % (vm, results.get(vm)))
+            else:
+                logger.info("virtual guest %s created" % vm)
+        if failed:
+            raise CX("cobbler trigger failed: unable to create %s" % ", ".join(failed))
+
+    return 0
+
+def createVms(target, vms, parallel, logger):
+    """
+    Run createvm for every guest with at most parallel of them at a time,
+    returns a dict of vm name to return code or error
+    """
+    work = Queue.Queue()
+    for vm in vms:
+        work.put(vm)
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                vm = work.get_nowait()
+            except Queue.Empty:
+                return
             try:
                 arglist = ["/usr/local/bin/createvm",target['ip_address_vmnic1'],vm,target['server']]
                 logger.info("creating virtual guest %s" % vm)
-                rc = utils.subprocess_call(logger, arglist, shell=False)
+                results[vm] = utils.subprocess_call(logger, arglist, shell=False)
             except Exception, reason:
-                logger.error("unable to create %s: %s" % (name,reason))
-            if rc != 0:
-                raise CX("cobbler trigger failed: %(file)s returns ")
+                results[vm] = reason
 
-    return 0
+    threads = [threading.Thread(target=worker) for i in range(min(parallel, len(vms)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
@@ -1,8 +1,15 @@
 #!/usr/bin/env jython
 
-import getpass, sys, socket, os, math
-from xmlrpclib import ServerProxy
+import getpass, sys, socket, os, math, time, copy, zlib, cPickle, re, atexit
+import jarray, hashlib
+import BaseHTTPServer, SocketServer, StringIO, threading, Queue
+from xmlrpclib import ServerProxy, MultiCall, ProtocolError, Fault
 from java.net import URL
+from java.lang import Exception as JavaException
+from java.lang.management import ManagementFactory
+from java.lang.reflect import Modifier
+from java.security import SecureRandom
+from java.io import ByteArrayInputStream, ByteArrayOutputStream
 from java.util import Calendar
 from java.text import DateFormat
 from optparse import OptionParser, OptionGroup, SUPPRESS_HELP
@@ -10,6 +17,8 @@ from com.vmware.vim25 import VirtualMachineCapability
 from com.vmware.vim25 import VirtualMachineConfigInfo
 from com.vmware.vim25 import VirtualMachineConfigSpec
 from com.vmware.vim25 import VirtualMachineFileInfo
+from com.vmware.vim25 import VirtualMachineCloneSpec
+from com.vmware.vim25 import VirtualMachineRelocateSpec
 from com.vmware.vim25 import VirtualDeviceConfigSpec
 from com.vmware.vim25 import VirtualDeviceConfigSpecOperation
 from com.vmware.vim25 import VirtualDeviceConfigSpecFileOperation
@@ -23,6 +32,7 @@ from com.vmware.vim25 import VirtualDiskFlatVer2BackingInfo
 from com.vmware.vim25 import VirtualE1000
 from com.vmware.vim25 import VirtualVmxnet2
 from com.vmware.vim25 import VirtualVmxnet3
+from com.vmware.vim25 import VirtualEthernetCard
 from com.vmware.vim25 import VirtualEthernetCardNetworkBackingInfo
 from com.vmware.vim25 import AutoStartDefaults
 from com.vmware.vim25 import HostAutoStartManagerConfig
@@ -30,11 +40,22 @@ from com.vmware.vim25 import Description
 from com.vmware.vim25 import OptionValue
 from com.vmware.vim25 import InvalidDatastore
 from com.vmware.vim25 import InvalidArgument
+from com.vmware.vim25 import NotSupported
+from com.vmware.vim25 import MethodFault
 from com.vmware.vim25 import LicenseManagerLicenseInfo
+from com.vmware.vim25 import ObjectSpec
+from com.vmware.vim25 import PropertySpec
+from com.vmware.vim25 import PropertyFilterSpec
+from com.vmware.vim25 import WaitOptions
+from com.vmware.vim25 import PerfQuerySpec
+from com.vmware.vim25 import PerfMetricId
+from com.vmware.vim25 import PerfEntityMetric
+from com.vmware.vim25 import ManagedObjectReference
 from com.vmware.vim25.mo import LicenseManager
 from com.vmware.vim25.mo import Folder
 from com.vmware.vim25.mo import InventoryNavigator
 from com.vmware.vim25.mo import ManagedEntity
+from com.vmware.vim25.mo import ManagedObject
 from com.vmware.vim25.mo import ServiceInstance
 from com.vmware.vim25.mo import VirtualMachine
 from com.vmware.vim25.mo import HostSystem
@@ -42,6 +63,87 @@ from com.vmware.vim25.mo import HostAutoStartManager
 from com.vmware.vim25.mo import Datacenter
 from com.vmware.vim25.mo import ResourcePool
 from com.vmware.vim25.mo.util import MorUtil
+from com.vmware.vim25.mo.util import PropertyCollectorUtil
+from com.vmware.vim25.ws import WSClient
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+# Property paths fetched in bulk for the inventory listings
+VM_LIST_PROPERTIES = ['name', 'config.uuid', 'config.guestFullName', 'config.hardware.numCPU',
+                      'config.hardware.memoryMB', 'config.annotation', 'runtime.powerState']
+HOST_LIST_PROPERTIES = ['name', 'configManager.autoStartManager', 'config.network.portgroup']
+HOST_HARDWARE_PROPERTIES = ['name', 'overallStatus', 'hardware.systemInfo', 'hardware.biosInfo',
+                            'hardware.cpuPkg', 'hardware.cpuInfo', 'hardware.memorySize']
+
+# Seconds between polls of the tasks in flight when the server lacks WaitForUpdatesEx
+TASK_POLL_INTERVAL = 1
+
+# Longest single WaitForUpdatesEx call in seconds
+TASK_WAIT_SLICE = 60
+
+# Directory of the --session-cache session cookie files
+SESSION_CACHE_DIR = os.path.expanduser('~/.vmware_cli/sessions')
+
+# Managed object types and property paths kept in the inventory snapshot
+SNAPSHOT_PROPERTIES = {'VirtualMachine': VM_LIST_PROPERTIES,
+                       'HostSystem': ['name'],
+                       'Datacenter': ['name'],
+                       'ResourcePool': ['name'],
+                       'Network': ['name']}
+
+# Directory of the --cache-max-age inventory snapshots
+SNAPSHOT_DIR = os.path.expanduser('~/.vmware_cli/inventory')
+
+# Directory of the koan records fetched from each Cobbler master
+COBBLER_CACHE_DIR = os.path.expanduser('~/.vmware_cli/cobbler')
+
+# Method and target of a vijava SOAP request, for --profile
+SOAP_CALL_PATTERN = re.compile(r'<soapenv:Body>\s*<(\w+)[^>]*>\s*(?:<_this type="(\w+)"[^>]*>([^<]*)</_this>)?')
+
+# Manually assigned macs must be in 00:50:56:00:00:00 - 00:50:56:3F:FF:FF
+MANUAL_MAC_PATTERN = re.compile(r'^00:50:56:[0-3][0-9a-f](:[0-9a-f]{2}){2}$', re.IGNORECASE)
+
+# Default address of the --daemon HTTP/JSON listener
+DAEMON_ADDRESS = '127.0.0.1:8707'
+
+# Token the --daemon listener requires from clients, readable only by its owner
+DAEMON_TOKEN_FILE = os.path.expanduser('~/.vmware_cli/daemon.token')
+
+# Unit number taken by the scsi controller itself
+RESERVED_UNITNUM = 7
+
+# Disk layout limits: scsi controllers per vm and disks per controller
+MAX_SCSI_CONTROLLERS = 4
+MAX_SCSI_DISKS = 15
+
+# Datastore summary fields read for --placement
+PLACEMENT_PROPERTIES = ['name', 'summary.accessible', 'summary.capacity', 'summary.freeSpace',
+                        'summary.uncommitted', 'summary.url']
+
+# Share of every datastore kept free by --placement
+PLACEMENT_FREE_RESERVE = 0.1
+
+# Realtime performance interval and number of samples (5 minutes) used
+# for the datastore latency of --placement leastlatency
+PERF_REALTIME_INTERVAL = 20
+PERF_LATENCY_SAMPLES = 15
+
+# First device keys of the scsi controllers and disks of a new vm
+SCSI_CONTROLLER_KEY = 1000
+DISK_KEY = 2000
+
+# Disk provisioning modes of the size[:role][:mode] disk syntax
+DISK_PROVISIONING = {'thin': 'thin', 'lazy': 'lazy', 'lazy-zero': 'lazy', 'thick': 'lazy',
+                     'eager': 'eager', 'eager-zero': 'eager'}
+# Disk roles of the size[:role][:mode] disk syntax, os disks stay on the
+# first scsi controller with the role layout
+DISK_ROLES = ['os', 'data', 'log', 'temp', 'swap', 'backup']
+SUPPORTED_HYPERVISORS = ['vmware']
 
 def getServiceInstance(svr,user,passwd,skipSSL):
     """ 
@@ -51,6 +153,55 @@ def getServiceInstance(svr,user,passwd,skipSSL):
     si = ServiceInstance(url,user,passwd,skipSSL)
     return si
 
+def getSessionCachePath(svr,user):
+    """
+    Return the file holding the cached session cookie for user on svr
+    """
+    return os.path.join(SESSION_CACHE_DIR, "%s@%s" % (user, svr))
+
+def loadCachedSession(svr,user,skipSSL):
+    """
+    Return a service instance reusing the cached session cookie for user
+    on svr, or None when there is no cached session or it has expired
+    """
+    try:
+        f = open(getSessionCachePath(svr,user))
+        try:
+            sessionStr = f.read().strip()
+        finally:
+            f.close()
+    except IOError:
+        return None
+    if not sessionStr:
+        return None
+
+    try:
+        url = URL("https://%s/sdk" % svr)
+        si = ServiceInstance(url,sessionStr,skipSSL)
+        # An expired session has no current session on the server
+        if si.getSessionManager().getCurrentSession():
+            return si
+    except (Exception, JavaException):
+        pass
+    return None
+
+def saveCachedSession(svr,user,si):
+    """
+    Store the session cookie of a service instance in a file only
+    readable by the current user
+    """
+    if not os.path.isdir(SESSION_CACHE_DIR):
+        os.makedirs(SESSION_CACHE_DIR, 0700)
+    path = getSessionCachePath(svr,user)
+    tmp = "%s.%d" % (path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    try:
+        os.write(fd, si.getServerConnection().getSessionStr())
+    finally:
+        os.close(fd)
+    os.chmod(tmp, 0600)
+    os.rename(tmp, path)
+
 def getExpirationDate(license_props):
     """
     Iterates through a property list and returns the expirationDate
@@ -152,39 +303,45 @@ def listLicenses(si):
         printLicenseDetails(props)
 
 def printHostHardwareSummary(si):
-    host = InventoryNavigator(si.getRootFolder()).searchManagedEntities("HostSystem")
     df = DateFormat.getInstance()
-    for h in host:
-        hinfo = h.getHardware()
-        print "Hypervisor Name: " + h.getName()
-        print hinfo.getSystemInfo().getVendor(),
-        print hinfo.getSystemInfo().getModel()
-        print "Bios: ", hinfo.getBiosInfo().getBiosVersion(),
-        print df.format(hinfo.getBiosInfo().getReleaseDate().getTime())
+    for h in retrieveProperties(si,"HostSystem",HOST_HARDWARE_PROPERTIES):
+        print "Hypervisor Name: " + h['name']
+        print h['hardware.systemInfo'].getVendor(),
+        print h['hardware.systemInfo'].getModel()
+        print "Bios: ", h['hardware.biosInfo'].getBiosVersion(),
+        print df.format(h['hardware.biosInfo'].getReleaseDate().getTime())
         print "Overall Status: ", 
-        print h.getOverallStatus().toString().capitalize()
-        print "CPU Info: ", hinfo.getCpuPkg()[0].getDescription()
-        print "\tCPU's: ", hinfo.getCpuInfo().getNumCpuPackages()
-        print "\tCores: ", hinfo.getCpuInfo().getNumCpuCores()
-        print "Memory Info: %.2f GB" % (hinfo.getMemorySize() * pow(10.0, -9))
+        print h['overallStatus'].toString().capitalize()
+        print "CPU Info: ", h['hardware.cpuPkg'][0].getDescription()
+        print "\tCPU's: ", h['hardware.cpuInfo'].getNumCpuPackages()
+        print "\tCores: ", h['hardware.cpuInfo'].getNumCpuCores()
+        print "Memory Info: %.2f GB" % (h['hardware.memorySize'] * pow(10.0, -9))
+
+def getManagedEntities(si,moType):
+    """
+    Return a list of all managed entities of moType in the inventory
+    """
+    conn = si.getServerConnection()
+    return [MorUtil.createExactManagedEntity(conn,row['mor']) for row in retrieveProperties(si,moType,['name'])]
 
 def getDatacenters(si):
     """
     Return a list of datacenter managed objects
     """
-    dcList = InventoryNavigator(si.getRootFolder()).searchManagedEntities("Datacenter")
+    dcList = getManagedEntities(si,"Datacenter")
     return dcList
 
 def getHostSystems(si):
     """
     Return a list of all host systems in the inventory
     """
-    hsList = InventoryNavigator(si.getRootFolder()).searchManagedEntities("HostSystem")
+    hsList = getManagedEntities(si,"HostSystem")
     return hsList
 
 def getResourcePools(si):
     """
-    Return a list of resource pool managed objects
+    Return a list of resource pool managed objects in inventory traversal
+    order, callers take the first one as the default pool
     """
     rpList = InventoryNavigator(si.getRootFolder()).searchManagedEntities("ResourcePool")
     return rpList
@@ -193,89 +350,401 @@ def getVirtualMachines(si):
     """
     Return a list of all virtual machines in the inventory
     """
-    vmList = InventoryNavigator(si.getRootFolder()).searchManagedEntities("VirtualMachine")
+    vmList = getManagedEntities(si,"VirtualMachine")
     return vmList
 
+def retrieveProperties(si,moType,propPaths,mos=None):
+    """
+    Fetch the given property paths for every managed object of moType
+    with a single PropertyCollector call.  When mos is None the whole
+    inventory is traversed from the root folder, otherwise only the given
+    managed objects (or managed object references) are read.
+
+    Reads are served from the inventory snapshot of the session when one
+    is in use and it tracks all requested paths.
+
+    @returns: list of dicts keyed by property path plus 'mor'
+    """
+    snapshot = inventorySnapshots.get(si.getServerConnection())
+    if snapshot and moType in SNAPSHOT_PROPERTIES:
+        tracked = SNAPSHOT_PROPERTIES[moType]
+        if len([p for p in propPaths if p not in tracked]) == 0:
+            return getSnapshotProperties(snapshot,moType,propPaths,mos)
+
+    propSpec = PropertySpec()
+    propSpec.setType(moType)
+    propSpec.setAll(False)
+    propSpec.setPathSet(propPaths)
+
+    objSpecs = []
+    if mos is None:
+        objSpec = ObjectSpec()
+        objSpec.setObj(si.getRootFolder().getMOR())
+        objSpec.setSkip(True)
+        objSpec.setSelectSet(PropertyCollectorUtil.buildFullTraversal())
+        objSpecs.append(objSpec)
+    else:
+        for mo in mos:
+            objSpec = ObjectSpec()
+            if isinstance(mo, ManagedObject):
+                objSpec.setObj(mo.getMOR())
+            else:
+                objSpec.setObj(mo)
+            objSpec.setSkip(False)
+            objSpecs.append(objSpec)
+        if not objSpecs:
+            return []
+
+    filterSpec = PropertyFilterSpec()
+    filterSpec.setPropSet([propSpec])
+    filterSpec.setObjectSet(objSpecs)
+
+    results = []
+    ocs = si.getPropertyCollector().retrieveProperties([filterSpec])
+    if ocs:
+        for oc in ocs:
+            props = {'mor': oc.getObj()}
+            if oc.getPropSet():
+                for dp in oc.getPropSet():
+                    # Unwrap ArrayOfXxx values into plain java arrays
+                    props[dp.getName()] = PropertyCollectorUtil.convertProperty(dp.getVal())
+            results.append(props)
+    return results
+
+class ThreadLocalCache:
+    """
+    Dict-like cache private to each thread, so concurrent daemon requests
+    and fan-out workers never see or reset each other's entries
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def data(self):
+        if not hasattr(self.local, 'data'):
+            self.local.data = {}
+        return self.local.data
+
+    def get(self, key, default=None):
+        return self.data().get(key, default)
+
+    def pop(self, key, default=None):
+        return self.data().pop(key, default)
+
+    def clear(self):
+        self.data().clear()
+
+    def __contains__(self, key):
+        return key in self.data()
+
+    def __getitem__(self, key):
+        return self.data()[key]
+
+    def __setitem__(self, key, value):
+        self.data()[key] = value
+
+# Inventory snapshots in use, keyed by server connection
+inventorySnapshots = ThreadLocalCache()
+
+def getSnapshotProperties(snapshot,moType,propPaths,mos=None):
+    """
+    Return rows like retrieveProperties from an inventory snapshot
+    """
+    if mos is not None:
+        wanted = {}
+        for mo in mos:
+            if isinstance(mo, ManagedObject):
+                mo = mo.getMOR()
+            wanted[mo.getVal()] = True
+    results = []
+    for key in snapshot['order']:
+        obj = snapshot['objects'][key]
+        if obj['type'] != moType or (mos is not None and obj['val'] not in wanted):
+            continue
+        mor = ManagedObjectReference()
+        mor.setType(obj['type'])
+        mor.setVal(obj['val'])
+        props = {'mor': mor}
+        for path in propPaths:
+            if path in obj:
+                props[path] = obj[path]
+        results.append(props)
+    return results
+
+def getSnapshotPath(svr):
+    """
+    Return the file holding the inventory snapshot of svr
+    """
+    return os.path.join(SNAPSHOT_DIR, svr)
+
+def loadInventorySnapshot(svr):
+    """
+    Read the inventory snapshot of svr, None when there is none
+    """
+    try:
+        f = open(getSnapshotPath(svr), 'rb')
+        try:
+            return cPickle.loads(zlib.decompress(f.read()))
+        finally:
+            f.close()
+    except (IOError, zlib.error, cPickle.UnpicklingError, EOFError):
+        return None
+
+def saveInventorySnapshot(svr,snapshot):
+    """
+    Write the inventory snapshot of svr as a compressed pickle only
+    readable by the current user
+    """
+    if not os.path.isdir(SNAPSHOT_DIR):
+        os.makedirs(SNAPSHOT_DIR, 0700)
+    path = getSnapshotPath(svr)
+    tmp = "%s.%d" % (path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    try:
+        os.write(fd, zlib.compress(cPickle.dumps(snapshot, 2)))
+    finally:
+        os.close(fd)
+    os.chmod(tmp, 0600)
+    os.rename(tmp, path)
+
+def snapshotValue(val):
+    """
+    Convert a property value to a plain python value for the snapshot
+    """
+    if val is None or isinstance(val, (int, long, float, basestring)):
+        return val
+    return str(val)
+
+def applySnapshotUpdates(snapshot,updates):
+    """
+    Apply a PropertyCollector update set to an inventory snapshot
+    """
+    snapshot['version'] = updates.getVersion()
+    for filterUpdate in updates.getFilterSet() or []:
+        for objectUpdate in filterUpdate.getObjectSet() or []:
+            mor = objectUpdate.getObj()
+            key = "%s:%s" % (mor.getType(), mor.getVal())
+            if str(objectUpdate.getKind()) == "leave":
+                if key in snapshot['objects']:
+                    del snapshot['objects'][key]
+                    snapshot['order'].remove(key)
+                continue
+            if key not in snapshot['objects']:
+                snapshot['objects'][key] = {'type': mor.getType(), 'val': mor.getVal()}
+                snapshot['order'].append(key)
+            obj = snapshot['objects'][key]
+            for change in objectUpdate.getChangeSet() or []:
+                if str(change.getOp()) in ("remove", "indirectRemove"):
+                    obj.pop(change.getName(), None)
+                else:
+                    obj[change.getName()] = snapshotValue(change.getVal())
+
+def createSnapshotCollector(si):
+    """
+    Create a private PropertyCollector with one filter over every
+    snapshot type, so its versions track inventory changes
+    """
+    propSpecs = []
+    for moType, paths in SNAPSHOT_PROPERTIES.items():
+        propSpec = PropertySpec()
+        propSpec.setType(moType)
+        propSpec.setAll(False)
+        propSpec.setPathSet(paths)
+        propSpecs.append(propSpec)
+    objSpec = ObjectSpec()
+    objSpec.setObj(si.getRootFolder().getMOR())
+    objSpec.setSkip(True)
+    objSpec.setSelectSet(PropertyCollectorUtil.buildFullTraversal())
+    filterSpec = PropertyFilterSpec()
+    filterSpec.setPropSet(propSpecs)
+    filterSpec.setObjectSet([objSpec])
+
+    pc = si.getPropertyCollector().createPropertyCollector()
+    pc.createFilter(filterSpec, True)
+    return pc
+
+def refreshInventorySnapshot(si,snapshot=None):
+    """
+    Bring an inventory snapshot up to date.  When the private collector
+    recorded in the snapshot still exists in this session only the
+    changes since its version token are fetched, otherwise a new
+    collector is created and the full inventory is read once.
+    """
+    conn = si.getServerConnection()
+    waitOptions = WaitOptions()
+    waitOptions.setMaxWaitSeconds(0)
+
+    pc = None
+    if snapshot and snapshot.get('collector'):
+        mor = ManagedObjectReference()
+        mor.setType("PropertyCollector")
+        mor.setVal(snapshot['collector'])
+        pc = MorUtil.createExactManagedObject(conn,mor)
+        try:
+            updates = pc.waitForUpdatesEx(snapshot['version'], waitOptions)
+        except (Exception, JavaException):
+            pc = None
+
+    if pc is None:
+        snapshot = {'collector': None, 'version': "", 'objects': {}, 'order': []}
+        try:
+            pc = createSnapshotCollector(si)
+            updates = pc.waitForUpdatesEx("", waitOptions)
+            snapshot['collector'] = pc.getMOR().getVal()
+        except (Exception, JavaException):
+            # No WaitForUpdatesEx on this server, read everything instead
+            for moType, paths in SNAPSHOT_PROPERTIES.items():
+                for row in retrieveProperties(si,moType,paths):
+                    key = "%s:%s" % (moType, row['mor'].getVal())
+                    obj = {'type': moType, 'val': row['mor'].getVal()}
+                    for path in paths:
+                        if path in row:
+                            obj[path] = snapshotValue(row[path])
+                    snapshot['objects'][key] = obj
+                    snapshot['order'].append(key)
+            updates = None
+
+    while updates is not None:
+        applySnapshotUpdates(snapshot,updates)
+        updates = pc.waitForUpdatesEx(snapshot['version'], waitOptions)
+
+    snapshot['time'] = time.time()
+    return snapshot
+
+def useInventorySnapshot(si,maxAge):
+    """
+    Serve reads of this session from the on-disk inventory snapshot,
+    refreshing it first when it is older than maxAge seconds
+    """
+    conn = si.getServerConnection()
+    svr = conn.getUrl().getHost()
+    snapshot = loadInventorySnapshot(svr)
+    if snapshot is None or time.time() - snapshot.get('time', 0) > maxAge:
+        snapshot = refreshInventorySnapshot(si,snapshot)
+        saveInventorySnapshot(svr,snapshot)
+    inventorySnapshots[conn] = snapshot
+
+# Dictionary to cache the vm name index per server connection
+vmNameIndex = ThreadLocalCache()
+def getVirtualMachineNameIndex(si):
+    """
+    Return a dict mapping each vm name to the list of its managed object
+    references.  The index is fetched once per session with a single
+    PropertyCollector call and reused by every lookup by name.
+    """
+    conn = si.getServerConnection()
+    if conn not in vmNameIndex:
+        index = {}
+        for vm in retrieveProperties(si,"VirtualMachine",['name']):
+            index.setdefault(vm.get('name'), []).append(vm['mor'])
+        vmNameIndex[conn] = index
+    return vmNameIndex[conn]
+
+def forgetVirtualMachineNameIndex(mo):
+    """
+    Drop the cached vm name index for the session a managed object
+    belongs to, after a vm has been created or deleted
+    """
+    vmNameIndex.pop(mo.getServerConnection(), None)
+
 def getVirtualMachineByName(si,vmname):
     """
     Return virtual machine with a given name
     """
-    vmList = []
-    for vm in getVirtualMachines(si):
-        if vmname == vm.getName():
-            vmList.append(vm)
+    mors = getVirtualMachineNameIndex(si).get(vmname, [])
 
-    if len(vmList) > 1:
+    if len(mors) > 1:
         print "Multiple virtual machines named %s.  Please lookup by UUID." % vmname
         return None
+    elif len(mors) == 0:
+        return None
     else:
-        return vmList[0]
+        return MorUtil.createExactManagedObject(si.getServerConnection(),mors[0])
 
 def getVirtualMachineByUUID(si,vmuuid):
     """
-    Return virtual machine with a given uuid
+    Return virtual machine with a given uuid using the server side SearchIndex
     """
-    for vm in getVirtualMachines(si):
-        if vmuuid == vm.getConfig().uuid:
-            return vm
-    return None
+    return si.getSearchIndex().findByUuid(None,vmuuid,True)
 
-def getPortgroups(hss):
+def getPortgroups(hss,portgroups=None):
     """
     Return each portgroup configuration
     """
+    if portgroups is None:
+        portgroups = hss.hostNetworkSystem.getNetworkConfig().getPortgroup()
     pgList = []
-    for pg in hss.hostNetworkSystem.getNetworkConfig().getPortgroup():
+    for pg in portgroups or []:
         pgList.append([pg.getSpec().vswitchName,pg.getSpec().name,pg.getSpec().vlanId])
     return pgList
 
-def listPortgroups(hss):
+def listPortgroups(hss,portgroups=None):
     """
     Print each portgroup and associated virtual switch and vlan info
     """
     FORMAT = '%-15s %-20s %-10s'
     print FORMAT % ('Virtual Switch', 'Portgroup', 'VLan ID')
     print FORMAT % ('=' * 15, '=' * 9, '=' * 7)
-    pgs = getPortgroups(hss)
+    pgs = getPortgroups(hss,portgroups)
     for pg in pgs:
         print FORMAT % (pg[0], pg[1], pg[2])
 
-def listVirtualMachines(vms):
+def listVirtualMachines(si,vms=None):
     """
-    Print each virtual machine's configuration
+    Print each virtual machine's configuration.  The listed properties
+    for all virtual machines are fetched in one PropertyCollector call.
     """
+    if isinstance(vms, VirtualMachine):
+        vms = [vms]
+    rows = retrieveProperties(si,"VirtualMachine",VM_LIST_PROPERTIES,vms)
+    if not rows:
+        return
+
     FORMAT = '%-22s %-36s %-38s %-3s %-10s %-20s %-4s'
     print FORMAT % ('VM Name', 'UUID', 'OS Full Name', 'CPU', 'MEM', 'Annotation', 'Power')
     print FORMAT % ('=' * 22, '=' * 36, '=' * 38, '=' * 3, '=' * 10, '=' * 20, '=' * 4) 
 
-    if isinstance(vms, VirtualMachine):
-        if "PowerOnVM_Task" in vms.getDisabledMethod():
+    for vm in rows:
+        if str(vm.get('runtime.powerState')) == "poweredOn":
             state = "ON"
         else:
             state = "OFF"
-        print FORMAT % (vms.getName(),vms.getConfig().uuid,vms.getConfig().getGuestFullName(),
-                        vms.getConfig().hardware.numCPU,vms.getConfig().hardware.memoryMB,
-                        vms.getConfig().annotation,state)
-    else:
-        for vm in vms:
-            if "PowerOnVM_Task" in vm.getDisabledMethod():
-                state = "ON"
-            else:
-                state = "OFF"
-            print FORMAT % (vm.getName(),vm.getConfig().uuid,vm.getConfig().getGuestFullName(),
-                            vm.getConfig().hardware.numCPU,vm.getConfig().hardware.memoryMB,
-                            vm.getConfig().annotation,state)
+        print FORMAT % (vm.get('name'),vm.get('config.uuid'),vm.get('config.guestFullName'),
+                        vm.get('config.hardware.numCPU'),vm.get('config.hardware.memoryMB'),
+                        vm.get('config.annotation'),state)
 
-def listHostSystems(si,hss):
+def listHostSystems(si,hss=None):
     """
     Print each esx(i) instance's configuration
     """   
+    if isinstance(hss, HostSystem):
+        hss = [hss]
+    rows = retrieveProperties(si,"HostSystem",HOST_LIST_PROPERTIES,hss)
+    if not rows:
+        return
+
+    # Fetch every autostart config, then every vm it references, in one call each
+    managers = [hs['configManager.autoStartManager'] for hs in rows if hs.get('configManager.autoStartManager')]
+    autoStartConfigs = {}
+    for hasm in retrieveProperties(si,"HostAutoStartManager",['config'],managers):
+        autoStartConfigs[hasm['mor'].getVal()] = hasm.get('config')
+    vmMors = []
+    for config in autoStartConfigs.values():
+        if config and config.getPowerInfo():
+            vmMors.extend([powerInfo.getKey() for powerInfo in config.getPowerInfo()])
+    vmNames = {}
+    for vm in retrieveProperties(si,"VirtualMachine",['name'],vmMors):
+        vmNames[vm['mor'].getVal()] = vm.get('name')
+
     FORMAT = '%-22s %-9s %-10s %-9s %-10s %-18s'
     print FORMAT % ('ESX Name','AutoStart','StartDelay','StopDelay','StopAction','Wait For Heartbeat')
     print FORMAT % ('=' * 22, '=' * 9, '=' * 10, '=' * 9, '=' * 10, '=' * 18)
 
-    if isinstance(hss, HostSystem):
-        enabled,startDelay,stopDelay,stopAction,waitForHeartbeat = getHostAutoStartOptionDefaults(hss)
+    for hs in rows:
+        host = MorUtil.createExactManagedObject(si.getServerConnection(),hs['mor'])
+        config = None
+        if hs.get('configManager.autoStartManager'):
+            config = autoStartConfigs.get(hs['configManager.autoStartManager'].getVal())
+        enabled,startDelay,stopDelay,stopAction,waitForHeartbeat = getHostAutoStartOptionDefaults(host,config)
         if enabled:
             autostatus = "ON"
         else:
@@ -284,53 +753,44 @@ def listHostSystems(si,hss):
             hbstatus = "ON"
         else:
             hbstatus = "OFF"
-        print FORMAT % (hss.getName(),autostatus,startDelay,stopDelay,stopAction,hbstatus)
+        print FORMAT % (hs['name'],autostatus,startDelay,stopDelay,stopAction,hbstatus)
         print
-        listHostVmAutoStartOption(si,hss)
-        listPortgroups(hss)
-    else:
-        for hs in hss:
-            enabled,startDelay,stopDelay,stopAction,waitForHeartbeat = getHostAutoStartOptionDefaults(hs)
-            if enabled:
-                autostatus = "ON"
-            else:
-                autostatus = "OFF"
-            if waitForHeartbeat:
-                hbstatus = "ON"
-            else:
-                hbstatus = "OFF"
-            print FORMAT % (hs.getName(),autostatus,startDelay,stopDelay,stopAction,hbstatus)
-            print
-            listHostVmAutoStartOption(si,hs)
-            listPortgroups(hs)
+        listHostVmAutoStartOption(si,host,config,vmNames)
+        listPortgroups(host,hs.get('config.network.portgroup'))
 
-def listDatacenters(dcs):
+def listDatacenters(si,dcs=None):
     """
     Print each virtual datacenter's configuration
     """
+    if isinstance(dcs, Datacenter):
+        dcs = [dcs]
+    rows = retrieveProperties(si,"Datacenter",['name'],dcs)
+    if not rows:
+        return
+
     FORMAT = '%-22s'
     print FORMAT % ('Datacenter')
     print FORMAT % ('=' * 22) 
 
-    if isinstance(dcs, Datacenter):
-        print dcs.getName()
-    else:
-        for dc in dcs:
-            print dc.getName()
+    for dc in rows:
+        print dc['name']
 
-def listResourcePools(rps):
+def listResourcePools(si,rps=None):
     """
     Print each resource pool's configuration
     """
+    if isinstance(rps, ResourcePool):
+        rps = [rps]
+    rows = retrieveProperties(si,"ResourcePool",['name'],rps)
+    if not rows:
+        return
+
     FORMAT = '%-22s'
     print FORMAT % ('Resource Pool')
     print FORMAT % ('=' * 22)
 
-    if isinstance(rps, ResourcePool):
-        print rps.getName()
-    else:
-        for rp in rps:
-            print rp.getName()
+    for rp in rows:
+        print rp['name']
 
 def deleteVm(vm):
     """
@@ -341,7 +801,8 @@ def deleteVm(vm):
         powerOffVm(vm)
         
     task = vm.destroy_Task()
-    if task.waitForMe() == "success":
+    if waitForTask(task) == "success":
+        forgetVirtualMachineNameIndex(vm)
         print "%s has been deleted" % (vmname)
     else:
         print "%s could not be deleted" % (vmname)
@@ -354,7 +815,7 @@ def powerOnVm(vm):
         print "%s is already powered ON" % vm.getName()
     else:
         task = vm.powerOnVM_Task(None)
-        if task.waitForMe() == "success":
+        if waitForTask(task) == "success":
             print "%s is being powered ON" % vm.getName()
         else:
             print "%s could not be powered ON" % vm.getName()
@@ -367,7 +828,7 @@ def powerOffVm(vm):
         print "%s is already powered OFF" % vm.getName()
     else:
         task = vm.powerOffVM_Task()
-        if task.waitForMe() == "success":
+        if waitForTask(task) == "success":
             print "%s is being powered OFF" % vm.getName()
         else:
             print "%s could not be powered OFF" % vm.getName()
@@ -380,7 +841,7 @@ def resetVm(vm):
         print "%s can not be reset" % vm.getName()
     else:
         task = vm.resetVM_Task()
-        if task.waitForMe() == "success":
+        if waitForTask(task) == "success":
             print "%s is being reset" % vm.getName()
         else:
             print "%s could not be reset" % vm.getName()
@@ -406,15 +867,286 @@ def resetAllVms(vms):
     for vm in vms:
         resetVm(vm)
 
-def getHostAutoStartOptionDefaults(host):
+class TaskWaiter:
     """
-    Return autostart configuration for a host
+    Tracks many Task objects through one PropertyCollector update stream
+    on info.state instead of one poller per task.  Tasks are registered
+    with add() and wait() dispatches their completion callbacks.
     """
-    enabled = host.getHostAutoStartManager().config.defaults.getEnabled()
-    startDelay = host.getHostAutoStartManager().config.defaults.getStartDelay()
-    stopDelay = host.getHostAutoStartManager().config.defaults.getStopDelay()
-    stopAction = host.getHostAutoStartManager().config.defaults.getStopAction()
-    waitForHeartbeat = host.getHostAutoStartManager().config.defaults.getWaitForHeartbeat()
+    def __init__(self, si):
+        self.si = si
+        self.version = ""
+        self.tasks = {}
+        self.legacy = False
+        # A private collector keeps our filters out of other waiters' updates
+        self.private = True
+        try:
+            self.pc = si.getPropertyCollector().createPropertyCollector()
+        except (Exception, JavaException):
+            self.pc = si.getPropertyCollector()
+            self.private = False
+
+    def add(self, task, callback=None):
+        """
+        Watch a task, callback(task, state, error, result) is called once
+        it reaches success or error
+        """
+        propSpec = PropertySpec()
+        propSpec.setType("Task")
+        propSpec.setAll(False)
+        propSpec.setPathSet(['info.state','info.error','info.result'])
+        objSpec = ObjectSpec()
+        objSpec.setObj(task.getMOR())
+        objSpec.setSkip(False)
+        filterSpec = PropertyFilterSpec()
+        filterSpec.setPropSet([propSpec])
+        filterSpec.setObjectSet([objSpec])
+
+        self.tasks[task.getMOR().getVal()] = {'task': task, 'callback': callback, 'state': None,
+                                              'error': None, 'result': None,
+                                              'filter': self.pc.createFilter(filterSpec, True)}
+
+    def pending(self):
+        """
+        Return the number of watched tasks that have not finished
+        """
+        return len([t for t in self.tasks.values() if t['state'] is None])
+
+    def state(self, task):
+        """
+        Return "success" or "error" for a finished task, otherwise None
+        """
+        return self.tasks[task.getMOR().getVal()]['state']
+
+    def wait(self, timeout=None, count=None):
+        """
+        Process updates until every watched task has finished, count tasks
+        finished during this call, or timeout seconds have elapsed
+
+        @returns: number of tasks still running
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        finished = 0
+        while self.pending() and (count is None or finished < count):
+            maxWait = TASK_WAIT_SLICE
+            if deadline is not None:
+                maxWait = int(min(maxWait, deadline - time.time()))
+                if maxWait <= 0:
+                    break
+            finished = finished + self.processUpdates(self.waitForUpdates(maxWait))
+        return self.pending()
+
+    def waitFor(self, task, timeout=None):
+        """
+        Wait for a single watched task, returning its final state or None
+        if the timeout expired first
+        """
+        t = self.tasks[task.getMOR().getVal()]
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while t['state'] is None:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+            self.wait(remaining, 1)
+        return t['state']
+
+    def waitForUpdates(self, maxWait):
+        """
+        Block for the next update set, falling back to polling
+        CheckForUpdates on servers without WaitForUpdatesEx.  Only a
+        server fault rejecting the call (or a vijava without the method)
+        switches to polling, connection errors are raised.
+        """
+        if not self.legacy:
+            waitOptions = WaitOptions()
+            waitOptions.setMaxWaitSeconds(maxWait)
+            try:
+                return self.pc.waitForUpdatesEx(self.version, waitOptions)
+            except (MethodFault, AttributeError):
+                self.legacy = True
+        updates = self.pc.checkForUpdates(self.version)
+        if updates is None:
+            time.sleep(TASK_POLL_INTERVAL)
+        return updates
+
+    def processUpdates(self, updates):
+        """
+        Apply an update set and dispatch callbacks of finished tasks
+
+        @returns: number of tasks that finished
+        """
+        if updates is None:
+            return 0
+        self.version = updates.getVersion()
+        finished = 0
+        for filterUpdate in updates.getFilterSet() or []:
+            for objectUpdate in filterUpdate.getObjectSet() or []:
+                t = self.tasks.get(objectUpdate.getObj().getVal())
+                if t is None or t['state'] is not None:
+                    continue
+                state = None
+                for change in objectUpdate.getChangeSet() or []:
+                    if change.getName() == 'info.state':
+                        state = str(change.getVal())
+                    elif change.getName() == 'info.error' and change.getVal():
+                        t['error'] = change.getVal().getLocalizedMessage()
+                    elif change.getName() == 'info.result':
+                        t['result'] = change.getVal()
+                if state in ("success", "error"):
+                    t['state'] = state
+                    t['filter'].destroyPropertyFilter()
+                    finished = finished + 1
+                    if t['callback']:
+                        t['callback'](t['task'], state, t['error'], t['result'])
+        return finished
+
+    def close(self):
+        """
+        Drop the filters of unfinished tasks and the private collector
+        """
+        for t in self.tasks.values():
+            if t['state'] is None:
+                try:
+                    t['filter'].destroyPropertyFilter()
+                except (Exception, JavaException):
+                    pass
+        if self.private:
+            try:
+                self.pc.destroyPropertyCollector()
+            except (Exception, JavaException):
+                pass
+
+def waitForTask(task, timeout=None):
+    """
+    Wait for a single task, returning "success" or "error" like
+    Task.waitForMe(), or None if the timeout expired first
+    """
+    waiter = TaskWaiter(task.getServerConnection().getServiceInstance())
+    try:
+        waiter.add(task)
+        return waiter.waitFor(task, timeout)
+    finally:
+        waiter.close()
+
+def runTasks(si,jobs,parallel):
+    """
+    Submit tasks with at most parallel of them in flight and wait on all
+    of them together through one TaskWaiter.
+
+    Each job is a (label, submit, done) tuple.  submit() returns the Task
+    it started, or None when there is nothing to wait for, and
+    done(label, state, error, result) is called as soon as that task
+    finishes.  done may return a list of follow-up jobs, which are queued
+    behind the pending ones.
+    """
+    pending = list(jobs)
+    waiter = TaskWaiter(si)
+
+    def dispatch(label, done):
+        return lambda task, state, error, result: pending.extend(done(label, state, error, result) or [])
+
+    try:
+        while pending or waiter.pending():
+            while pending and waiter.pending() < parallel:
+                label, submit, done = pending.pop(0)
+                try:
+                    task = submit()
+                except (Exception, JavaException), reason:
+                    pending.extend(done(label, "error", reason, None) or [])
+                    continue
+                if task:
+                    waiter.add(task, dispatch(label, done))
+            if waiter.pending():
+                waiter.wait(count=1)
+    finally:
+        waiter.close()
+
+def getVmStartOrder(si):
+    """
+    Return a dict of vm managed object reference value to the autostart
+    startOrder configured on its host
+    """
+    hosts = retrieveProperties(si,"HostSystem",['configManager.autoStartManager'])
+    managers = [h['configManager.autoStartManager'] for h in hosts if h.get('configManager.autoStartManager')]
+    startOrder = {}
+    for hasm in retrieveProperties(si,"HostAutoStartManager",['config.powerInfo'],managers):
+        for powerInfo in hasm.get('config.powerInfo') or []:
+            startOrder[powerInfo.getKey().getVal()] = powerInfo.getStartOrder()
+    return startOrder
+
+def powerAllVmsConcurrently(si,vms,operation,parallel,ordered):
+    """
+    Power on, off or reset many virtual machines with up to parallel
+    tasks in flight, printing each result as its task finishes.  When
+    ordered is set vms are started in groups following the host autostart
+    startOrder (unordered vms last) and stopped in the reverse order.
+    """
+    if operation == "on":
+        method, verb = "powerOnVM_Task", "powered ON"
+    elif operation == "off":
+        method, verb = "powerOffVM_Task", "powered OFF"
+    else:
+        method, verb = "resetVM_Task", "reset"
+
+    def taskDone(label, state, error, result):
+        if state == "success":
+            print "%s is being %s" % (label, verb)
+        elif error:
+            print "%s could not be %s (%s)" % (label, verb, error)
+        else:
+            print "%s could not be %s" % (label, verb)
+
+    def submitter(vm):
+        if method == "powerOnVM_Task":
+            return lambda: vm.powerOnVM_Task(None)
+        return getattr(vm, method)
+
+    groups = {}
+    startOrder = {}
+    if ordered:
+        startOrder = getVmStartOrder(si)
+    for row in retrieveProperties(si,"VirtualMachine",['name','runtime.powerState'],vms):
+        powerState = str(row.get('runtime.powerState'))
+        if operation == "on" and powerState == "poweredOn":
+            print "%s is already powered ON" % row['name']
+            continue
+        elif operation == "off" and powerState == "poweredOff":
+            print "%s is already powered OFF" % row['name']
+            continue
+        elif operation == "reset" and powerState != "poweredOn":
+            print "%s can not be reset" % row['name']
+            continue
+        vm = MorUtil.createExactManagedObject(si.getServerConnection(),row['mor'])
+        order = startOrder.get(row['mor'].getVal(), -1)
+        if order < 1:
+            order = sys.maxint
+        groups.setdefault(order, []).append((row['name'], submitter(vm), taskDone))
+
+    orders = sorted(groups.keys())
+    if operation != "on":
+        orders.reverse()
+    for order in orders:
+        runTasks(si,groups[order],parallel)
+
+def getHostAutoStartOptionDefaults(host,config=None):
+    """
+    Return autostart configuration for a host, read from the host unless
+    its autostart manager config is given
+    """
+    if config is None:
+        config = host.getHostAutoStartManager().config
+    defaults = config.defaults
+    enabled = defaults.getEnabled()
+    startDelay = defaults.getStartDelay()
+    stopDelay = defaults.getStopDelay()
+    stopAction = defaults.getStopAction()
+    waitForHeartbeat = defaults.getWaitForHeartbeat()
     return ([enabled,startDelay,stopDelay,stopAction,waitForHeartbeat])
 
 def setHostAutoStartOptionDefaults(host,isEnabled,startDelay,stopDelay,stopAction,waitForHeartbeat):
@@ -437,18 +1169,24 @@ def setHostAutoStartOptionDefaults(host,isEnabled,startDelay,stopDelay,stopActio
     hasm = host.getHostAutoStartManager()
     hasm.reconfigureAutostart(asSpec)
 
-def listHostVmAutoStartOption(si,host):
+def listHostVmAutoStartOption(si,host,config=None,vmNames=None):
     """
-    Return autostart configuration for a virutal machine
+    Return autostart configuration for a virutal machine.  The host's
+    autostart config and a dict of vm names by managed object reference
+    value are fetched in bulk unless given.
     """
-    if host.getHostAutoStartManager().config.powerInfo:
+    if config is None:
+        config = host.getHostAutoStartManager().config
+    if config.powerInfo:
+        if vmNames is None:
+            vmNames = {}
+            for vm in retrieveProperties(si,"VirtualMachine",['name'],[p.getKey() for p in config.powerInfo]):
+                vmNames[vm['mor'].getVal()] = vm.get('name')
         FORMAT = '%-22s %-11s %-11s %-11s %-13s %-11s %-11s'
         print FORMAT % ('VM Name','StartAction','StartDelay','StartOrder','StopAction','StopDelay','WaitForHeartBeat')
         print FORMAT % ('=' * 22, '=' * 11, '=' * 11, '=' * 11, '=' * 13, '=' * 11,'=' * 11)
-        config = []
-        for mor in host.getHostAutoStartManager().config.powerInfo:
-            vm = MorUtil.createExactManagedObject(si.getServerConnection(),mor.getKey())
-            print FORMAT % (vm.name,mor.startAction,mor.startDelay,mor.startOrder,mor.stopAction,mor.stopDelay,mor.waitForHeartbeat)
+        for mor in config.powerInfo:
+            print FORMAT % (vmNames.get(mor.getKey().getVal()),mor.startAction,mor.startDelay,mor.startOrder,mor.stopAction,mor.stopDelay,mor.waitForHeartbeat)
 
 def setHostVmAutoStartOption(vm):
     """ 
@@ -477,9 +1215,10 @@ def createScsiSpec(scsiKey,busNumber,scsiType):
 
     return scsiSpec
 
-def createDiskSpec(scsiKey,diskKey,unitNumber,diskSize,diskMode,datastore):
+def createDiskSpec(scsiKey,diskKey,unitNumber,diskSize,diskMode,datastore,provisioning="thin"):
     """
-    Define a virtual disk spec
+    Define a virtual disk spec, provisioning is thin, lazy (zeroed on
+    first write) or eager (zeroed at creation)
     """
     diskSpec = VirtualDeviceConfigSpec()
     diskSpec.setOperation(VirtualDeviceConfigSpecOperation.add)
@@ -493,7 +1232,9 @@ def createDiskSpec(scsiKey,diskKey,unitNumber,diskSize,diskMode,datastore):
     fileName = "["+datastore+"]"
     diskfileBacking.setFileName(fileName)
     diskfileBacking.setDiskMode(diskMode)
-    diskfileBacking.setThinProvisioned(True)
+    diskfileBacking.setThinProvisioned(provisioning == "thin")
+    if provisioning == "eager":
+        diskfileBacking.setEagerlyScrub(True)
     vd.setBacking(diskfileBacking)
     diskSpec.setDevice(vd)
 
@@ -518,9 +1259,10 @@ def createNicSpec(nicKey,netName,macAddress,nicType):
     nic.setBacking(nicBacking)
     # Address type is one of the following "generated", "manual", "assigned" by VC
     if macAddress:
+        if not MANUAL_MAC_PATTERN.match(macAddress):
+            raise VmCreateError("%s is not in the manual range 00:50:56:00:00:00 - 00:50:56:3F:FF:FF" % macAddress)
         nic.setAddressType("manual")
-        # MacAddress format is not validated here.
-        nic.setMacAddress(macAddress)
+        nic.setMacAddress(macAddress.lower())
     else:
         nic.setAddressType("generated")
     nicSpec.setDevice(nic)
@@ -555,14 +1297,890 @@ def ipAddressToVMwareMac(ipaddress):
     """
     Generate a mac address based on a given ip address.
     This takes the last 3 octets of an ip, turns them into hex,
-    appends that to the vmware vm range 00:05:56, and returns it
+    appends that to the vmware vm range 00:05:56, and returns it.
+    The first of them is folded into 00-3F to stay in the manual range,
+    collisions this may cause are caught by the mac conflict check.
     """
     p1,p2,p3,p4 = ipaddress.split('.')
-    return "00:50:56:%x:%x:%x" % (int(p2),int(p3),int(p4))
+    return "00:50:56:%02x:%02x:%02x" % (int(p2) & 0x3f,int(p3),int(p4))
 
-def getCommandLineOpts():
+class VmCreateError(Exception):
+    """
+    Raised when the spec for a new virtual machine can not be built
     """
-    Parses command line options
+    pass
+
+def parseDiskDefinition(disk,provisioning="thin"):
+    """
+    Parse a size[:role][:mode] disk definition, size is in Gb, role one
+    of DISK_ROLES used by the role layout and mode one of thin, lazy-zero
+    or eager-zero.  With a single field after the size it may be either.
+
+    @returns: 3-tuple of (size in Kb, role, provisioning)
+    """
+    fields = [f.strip() for f in str(disk).split(':')]
+    if len(fields) > 3:
+        raise VmCreateError("Invalid disk definition %s, expected size[:role][:mode]" % disk)
+    try:
+        size = int(float(fields[0]) * 1024 * 1024)
+    except ValueError:
+        raise VmCreateError("Invalid disk size in %s" % disk)
+    role = mode = ""
+    if len(fields) == 3:
+        role, mode = fields[1].lower(), fields[2].lower()
+    elif len(fields) == 2:
+        if fields[1].lower() in DISK_PROVISIONING:
+            mode = fields[1].lower()
+        else:
+            role = fields[1].lower()
+    if role and role not in DISK_ROLES:
+        raise VmCreateError("Invalid disk role %s in %s, expected one of %s"
+                            % (role, disk, ", ".join(DISK_ROLES)))
+    if mode:
+        if mode not in DISK_PROVISIONING:
+            raise VmCreateError("Invalid disk mode %s in %s, expected thin, lazy-zero or eager-zero"
+                                % (mode, disk))
+        provisioning = DISK_PROVISIONING[mode]
+    return size, role, provisioning
+
+def layoutDisks(disks,controllers,layout):
+    """
+    Assign parsed disks to scsi controllers.  The roundrobin layout deals
+    them out in turn; the role layout keeps the first disk and os disks on
+    controller 0 and gives every other role its own controller, wrapping
+    around the remaining controllers when there are more roles.
+
+    @returns: list of (bus number, unit number, disk) in disk order
+    """
+    roles = []
+    buses = []
+    for i, (size, role, provisioning) in enumerate(disks):
+        if layout == "role":
+            if controllers == 1 or i == 0 or role in ("", "os"):
+                bus = 0
+            else:
+                if role not in roles:
+                    roles.append(role)
+                bus = 1 + roles.index(role) % (controllers - 1)
+        else:
+            bus = i % controllers
+        buses.append(bus)
+
+    units = [0] * controllers
+    layoutList = []
+    for bus, disk in zip(buses, disks):
+        if units[bus] == RESERVED_UNITNUM:
+            # Skip the unit number assigned to the scsi controller (7)
+            units[bus] = units[bus] + 1
+        if units[bus] > MAX_SCSI_DISKS:
+            raise VmCreateError("More than %d disks on scsi controller %d, add controllers" % (MAX_SCSI_DISKS, bus))
+        layoutList.append((bus, units[bus], disk))
+        units[bus] = units[bus] + 1
+    return layoutList
+
+def createDiskSpecs(disks,datastore,opts,placer=None):
+    """
+    Define the scsi controllers plus one virtual disk spec per disk
+    definition, laid out over opts.scsiControllers controllers.  The
+    first controller is of opts.scsiType, the others of opts.dataScsiType.
+    Disks go to datastore, or to the datastore picked by placer.
+    """
+    configSpecs = []
+    diskMode = "persistent" # Changes are immediately and permanently written to the virtual disk.
+    if not disks:
+        return configSpecs
+
+    controllers = opts.scsiControllers or 1
+    if controllers < 1 or controllers > MAX_SCSI_CONTROLLERS:
+        raise VmCreateError("Between 1 and %d scsi controllers are supported" % MAX_SCSI_CONTROLLERS)
+    provisioning = opts.diskProvisioning or "thin"
+    if provisioning not in DISK_PROVISIONING:
+        raise VmCreateError("Unknown disk provisioning %s" % provisioning)
+    parsed = [parseDiskDefinition(disk,DISK_PROVISIONING[provisioning]) for disk in disks]
+    layoutList = layoutDisks(parsed,controllers,opts.diskLayout)
+
+    for bus in sorted(dict([(bus, True) for bus, unit, disk in layoutList]).keys()):
+        scsiType = opts.scsiType
+        if bus > 0 and opts.dataScsiType:
+            scsiType = opts.dataScsiType
+        configSpecs.append(createScsiSpec(SCSI_CONTROLLER_KEY + bus,bus,scsiType))
+
+    diskKey = DISK_KEY
+    for bus, unit, (size, role, provisioning) in layoutList:
+        diskDatastore = datastore
+        if placer:
+            diskDatastore = placer.place(opts.name,size,provisioning)
+        configSpecs.append(createDiskSpec(SCSI_CONTROLLER_KEY + bus,diskKey,unit,size,diskMode,diskDatastore,provisioning))
+        diskKey = diskKey + 1
+
+    return configSpecs
+
+def getDatastoreLatencies(si,datastores):
+    """
+    Return the average read plus write latency in ms over the last
+    minutes of every datastore, from one QueryPerf call over all hosts.
+    Datastores the hosts report no samples for are left out.
+    """
+    perfManager = si.getPerformanceManager()
+    counters = {}
+    for counter in perfManager.getPerfCounter() or []:
+        if counter.getGroupInfo().getKey() == "datastore" and str(counter.getRollupType()) == "average" and \
+           counter.getNameInfo().getKey() in ("totalReadLatency", "totalWriteLatency"):
+            counters[counter.getKey()] = counter.getNameInfo().getKey()
+    if not counters:
+        return {}
+
+    querySpecs = []
+    for host in retrieveProperties(si,"HostSystem",['name']):
+        metricIds = []
+        for key in counters.keys():
+            metricId = PerfMetricId()
+            metricId.setCounterId(key)
+            metricId.setInstance("*")
+            metricIds.append(metricId)
+        querySpec = PerfQuerySpec()
+        querySpec.setEntity(host['mor'])
+        querySpec.setMetricId(metricIds)
+        querySpec.setIntervalId(PERF_REALTIME_INTERVAL)
+        querySpec.setMaxSample(PERF_LATENCY_SAMPLES)
+        querySpecs.append(querySpec)
+
+    # Datastore counters are reported per datastore uuid, the last part of its url
+    names = {}
+    for name, ds in datastores.items():
+        names[ds['url'].rstrip('/').split('/')[-1]] = name
+        names[name] = name
+
+    samples = {}
+    for metric in perfManager.queryPerf(querySpecs) or []:
+        if not isinstance(metric, PerfEntityMetric):
+            continue
+        for series in metric.getValue() or []:
+            name = names.get(series.getId().getInstance())
+            values = [v for v in series.getValue() or [] if v >= 0]
+            if name and values:
+                # Read and write latency add up to the latency of a mixed load
+                total = samples.setdefault(name, {})
+                total[series.getId().getCounterId()] = float(sum(values)) / len(values)
+    latencies = {}
+    for name, total in samples.items():
+        latencies[name] = sum(total.values())
+    return latencies
+
+class DatastorePlacer:
+    """
+    Picks the datastore of the files and of every disk of new virtual
+    machines from one batched read of the datastore summaries (plus the
+    recent latency for leastlatency).  Space handed out is reserved for
+    the rest of the run, so many vms created together are placed as if
+    the earlier ones already existed.
+
+    Policies: mostfree takes the datastore with the most free space,
+    leastlatency the one with the lowest latency and spread the one that
+    received the fewest disks so far.  Only the datastores mounted by the
+    compute resource owning resourcePool are considered.
+    """
+    def __init__(self, si, policy, resourcePool, maxProvisioned=None):
+        self.policy = policy
+        self.maxProvisioned = maxProvisioned
+        self.datastores = {}
+        self.reservations = {}
+        mounted = resourcePool.getOwner().getDatastores() or []
+        for row in retrieveProperties(si,"Datastore",PLACEMENT_PROPERTIES,mounted):
+            if not row.get('summary.accessible') or not row.get('summary.capacity'):
+                continue
+            capacity = row['summary.capacity']
+            free = row.get('summary.freeSpace') or 0
+            self.datastores[row['name']] = {'capacity': capacity, 'free': free,
+                                            'provisioned': capacity - free + (row.get('summary.uncommitted') or 0),
+                                            'url': row.get('summary.url') or '', 'latency': None, 'placed': 0}
+        if policy == "leastlatency":
+            try:
+                latencies = getDatastoreLatencies(si,self.datastores)
+            except (Exception, JavaException), reason:
+                print "Unable to read datastore latency, placing by free space (%s)" % reason
+                latencies = {}
+            for name, latency in latencies.items():
+                self.datastores[name]['latency'] = latency
+
+    def rank(self, name):
+        ds = self.datastores[name]
+        if self.policy == "leastlatency":
+            return (ds['latency'] is None, ds['latency'], -ds['free'], name)
+        elif self.policy == "spread":
+            return (ds['placed'], -ds['free'], name)
+        return (-ds['free'], name)
+
+    def place(self, vmName, sizeKB, provisioning):
+        """
+        Reserve sizeKB for a file or disk of vmName, thick disks take
+        the space from the free space, thin disks only count as provisioned
+
+        @returns: name of the datastore
+        """
+        size = long(sizeKB) * 1024
+        freeUse = 0
+        if provisioning != "thin":
+            freeUse = size
+        candidates = []
+        for name, ds in self.datastores.items():
+            if ds['free'] - freeUse < ds['capacity'] * PLACEMENT_FREE_RESERVE:
+                continue
+            if self.maxProvisioned and float(ds['provisioned'] + size) / ds['capacity'] > self.maxProvisioned:
+                continue
+            candidates.append(name)
+        if not candidates:
+            raise VmCreateError("No datastore has room for %d Mb of %s" % (sizeKB / 1024, vmName))
+
+        choice = min(candidates, key=self.rank)
+        ds = self.datastores[choice]
+        ds['free'] = ds['free'] - freeUse
+        ds['provisioned'] = ds['provisioned'] + size
+        ds['placed'] = ds['placed'] + 1
+        self.reservations.setdefault(vmName, []).append((choice, freeUse, size))
+        return choice
+
+    def release(self, vmName):
+        """
+        Give back the space reserved for a vm that was not created
+        """
+        for name, freeUse, size in self.reservations.pop(vmName, []):
+            ds = self.datastores[name]
+            ds['free'] = ds['free'] + freeUse
+            ds['provisioned'] = ds['provisioned'] - size
+            ds['placed'] = ds['placed'] - 1
+
+def createNicSpecs(nics,nicType):
+    """
+    Define one virtual nic spec per (port group, mac address) pair
+    """
+    configSpecs = []
+    nicKey = 0
+    for netName, macAddress in nics:
+        configSpecs.append(createNicSpec(nicKey,netName,macAddress,nicType))
+        nicKey = nicKey + 1
+    return configSpecs
+
+# Koan records checked against their Cobbler master during this run,
+# keyed by (master, system name)
+cobblerSystems = ThreadLocalCache()
+
+def getCobblerCachePath(cblr_master):
+    return os.path.join(COBBLER_CACHE_DIR, cblr_master)
+
+def loadCobblerCache(cblr_master):
+    """
+    Read the cached koan records of a Cobbler master, a dict of
+    system name to (mtimes, record, last modified time of the master)
+    """
+    try:
+        f = open(getCobblerCachePath(cblr_master), 'rb')
+        try:
+            return cPickle.loads(zlib.decompress(f.read()))
+        finally:
+            f.close()
+    except (IOError, zlib.error, cPickle.UnpicklingError, EOFError):
+        return {}
+
+def saveCobblerCache(cblr_master,cache):
+    if not os.path.isdir(COBBLER_CACHE_DIR):
+        os.makedirs(COBBLER_CACHE_DIR, 0700)
+    path = getCobblerCachePath(cblr_master)
+    tmp = "%s.%d" % (path, os.getpid())
+    f = open(tmp, 'wb')
+    try:
+        f.write(zlib.compress(cPickle.dumps(cache, 2)))
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+def getCobblerObjects(conn,method,names):
+    """
+    Return the records of several Cobbler objects of one kind, fetched
+    with a single multicall of method, keyed by name.  Unknown objects
+    are left out.
+    """
+    records = {}
+    if names:
+        multicall = MultiCall(conn)
+        for name in names:
+            getattr(multicall, method)(name)
+        for name, record in zip(names, multicall()):
+            # get_* return "~" for unknown objects
+            if isinstance(record, dict):
+                records[name] = record
+    return records
+
+def getCobblerMtimes(conn,systems):
+    """
+    Return for each system record the mtimes of everything its koan view
+    is rendered from: the system, its profile chain and their distro, or
+    its image
+    """
+    profiles = {}
+    wanted = dict([(s.get('profile'), True) for s in systems.values() if s.get('profile')]).keys()
+    requested = {}
+    while wanted:
+        for name in wanted:
+            requested[name] = True
+        profiles.update(getCobblerObjects(conn,'get_profile',wanted))
+        wanted = dict([(p.get('parent'), True) for p in profiles.values()
+                       if p.get('parent') and p.get('parent') not in requested]).keys()
+    distros = getCobblerObjects(conn,'get_distro',
+                                dict([(p.get('distro'), True) for p in profiles.values() if p.get('distro')]).keys())
+    images = getCobblerObjects(conn,'get_image',
+                               dict([(s.get('image'), True) for s in systems.values() if s.get('image')]).keys())
+
+    mtimes = {}
+    for name, system in systems.items():
+        key = [system.get('mtime')]
+        if system.get('image'):
+            key.append(images.get(system['image'], {}).get('mtime'))
+        profile = system.get('profile')
+        seen = {}
+        while profile and profile not in seen:
+            seen[profile] = True
+            record = profiles.get(profile, {})
+            key.append(record.get('mtime'))
+            if record.get('distro'):
+                key.append(distros.get(record['distro'], {}).get('mtime'))
+            profile = record.get('parent')
+        mtimes[name] = tuple(key)
+    return mtimes
+
+def fetchCobblerSystems(cblr_master,names):
+    """
+    Load the koan records of several Cobbler systems into cobblerSystems.
+    One last_modified_time call tells whether anything changed on the
+    master since a cached record was checked; if not the cache is used
+    as is.  Otherwise a single system is simply fetched again, while for
+    several systems multicalls of get_system, get_profile and get_distro
+    (or get_image) find the ones whose koan view changed and only those
+    are fetched again, with a multicall of get_system_for_koan.
+    """
+    names = [name for name in names if (cblr_master, name) not in cobblerSystems]
+    if not names:
+        return
+
+    conn = ServerProxy("http://%s/cobbler_api" % cblr_master)
+    cache = loadCobblerCache(cblr_master)
+    changed = False
+    try:
+        try:
+            modified = conn.last_modified_time()
+        except Fault:
+            # Older masters, always check the object mtimes
+            modified = None
+
+        # Cache entries are (mtimes, record, last_modified_time when checked)
+        unchecked = [name for name in names
+                     if modified is None or name not in cache or cache[name][2:] != (modified,)]
+        if len(unchecked) == 1:
+            fetch = dict([(name, None) for name in unchecked])
+        elif unchecked:
+            fetch = getCobblerMtimes(conn,getCobblerObjects(conn,'get_system',unchecked))
+            for name in unchecked:
+                if name in fetch and name in cache and cache[name][0] == fetch[name]:
+                    cache[name] = (fetch[name], cache[name][1], modified)
+                    del fetch[name]
+                    changed = True
+                elif name not in fetch and name in cache:
+                    del cache[name]
+                    changed = True
+        else:
+            fetch = {}
+
+        if fetch:
+            multicall = MultiCall(conn)
+            for name in fetch:
+                multicall.get_system_for_koan(name)
+            for name, server in zip(fetch.keys(), multicall()):
+                if isinstance(server, dict) and server:
+                    cache[name] = (fetch[name], server, modified)
+                elif name in cache:
+                    # Unknown to the master
+                    del cache[name]
+            changed = True
+    except (socket.gaierror, socket.error, ProtocolError, Fault), reason:
+        raise VmCreateError("Unable to connect to %s (%s) " % (cblr_master, reason))
+
+    if changed:
+        saveCobblerCache(cblr_master, cache)
+
+    for name in names:
+        if name in cache:
+            cobblerSystems[(cblr_master, name)] = cache[name][1]
+
+def getCobblerSystem(cblr_master,name):
+    """
+    Return the koan view of a Cobbler system
+    """
+    fetchCobblerSystems(cblr_master,[name])
+    server = cobblerSystems.get((cblr_master, name))
+
+    if not server:
+        raise VmCreateError("Unable to get system information for %s (exiting) " % (name))
+
+    virt_type = server.get("virt_type")
+    if virt_type not in SUPPORTED_HYPERVISORS:
+        raise VmCreateError("Unsupported virt type %s (exiting)" % virt_type)
+
+    # Spec building may fill in generated macs
+    return copy.deepcopy(server)
+
+def buildCobblerVmSpec(name,server,opts,placer=None):
+    """
+    Create a virtual machine spec from a Cobbler system
+    """
+    virt_cpus = server.get("virt_cpus",None)
+    virt_ram = server.get("virt_ram",None)
+    comment = server.get("comment",None)
+
+    virt_path = server.get("virt_path",None)
+    virt_file_size = server.get("virt_file_size",None)
+    if placer:
+        # The vm files include a swap file the size of its memory
+        virt_path = placer.place(name,int(virt_ram or opts.memorysize) * 1024,"lazy")
+
+    configSpecs = []
+    if virt_file_size and virt_path:
+        # Clones take their disks from the template, only place real ones
+        diskPlacer = not opts.template and placer or None
+        configSpecs.extend(createDiskSpecs(str(virt_file_size).split(','),virt_path,opts,diskPlacer))
+
+    nics = []
+    interfaces = server.get("interfaces", None)
+    if interfaces:
+        for k in sorted(interfaces.iterkeys()):
+            if k.find(":") == -1 and k.find(".") == -1:
+
+                # Generate VMware MAC based on IP
+                if (opts.genmac and k == "eth1"):
+                    interfaces[k]["mac_address"] = ipAddressToVMwareMac(interfaces[k]["ip_address"])
+
+                nics.append((interfaces[k]["virt_bridge"],interfaces[k]["mac_address"]))
+    configSpecs.extend(createNicSpecs(nics,opts.nicType))
+
+    return createVmSpec(name,virt_cpus,virt_ram,opts.guestos,comment,virt_path,configSpecs)
+
+def buildVmSpec(opts,placer=None):
+    """
+    Create the spec for virtual machine opts.name from its Cobbler system
+    when opts.cblr_master is set, otherwise from the virtual hardware
+    options.  With a DatastorePlacer the datastores are chosen by it.
+    """
+    # Pull the Virtual hardware info from Cobbler
+    if opts.cblr_master:
+        server = getCobblerSystem(opts.cblr_master,opts.name)
+        return buildCobblerVmSpec(opts.name,server,opts,placer)
+
+    # Use Command line options for Virtual Hardware options
+    datastore = opts.datastore
+    if placer:
+        # The vm files include a swap file the size of its memory
+        datastore = placer.place(opts.name,int(opts.memorysize) * 1024,"lazy")
+    # Clones take their disks from the template, only place real ones
+    diskPlacer = not opts.template and placer or None
+    configSpecs = createDiskSpecs(opts.disk,datastore,opts,diskPlacer)
+
+    nics = []
+    for nic in opts.nic or []:
+        try:
+            netName, macAddress = nic.split(',',1)
+        except ValueError:
+            netName = nic
+            macAddress = None
+        nics.append((netName,macAddress))
+    configSpecs.extend(createNicSpecs(nics,opts.nicType))
+
+    return createVmSpec(opts.name,opts.cpucount,opts.memorysize,opts.guestos,opts.annotation,datastore,configSpecs)
+
+def findSnapshot(trees,name):
+    """
+    Return the snapshot reference named name in a snapshot tree list
+    """
+    for tree in trees or []:
+        if tree.getName() == name:
+            return tree.getSnapshot()
+        snapshot = findSnapshot(tree.getChildSnapshotList(),name)
+        if snapshot:
+            return snapshot
+    return None
+
+def getCloneSource(si,opts,templates):
+    """
+    Return (template vm, template devices, snapshot reference or None)
+    for opts.template, caching the lookups of a run in templates
+    """
+    if opts.prune and opts.template == opts.name:
+        raise VmCreateError("Unable to prune %s, it is the template to clone" % opts.name)
+    key = (opts.template, opts.snapshot, opts.linked)
+    if key in templates:
+        return templates[key]
+
+    template = getVirtualMachineByName(si,opts.template)
+    if template is None:
+        raise VmCreateError("Unable to find template %s" % opts.template)
+    props = retrieveProperties(si,"VirtualMachine",['config.hardware.device','snapshot'],[template])[0]
+    snapshotInfo = props.get('snapshot')
+
+    snapshot = None
+    if opts.snapshot:
+        if snapshotInfo:
+            snapshot = findSnapshot(snapshotInfo.getRootSnapshotList(),opts.snapshot)
+        if snapshot is None:
+            raise VmCreateError("Template %s has no snapshot %s" % (opts.template, opts.snapshot))
+    elif opts.linked:
+        if snapshotInfo:
+            snapshot = snapshotInfo.getCurrentSnapshot()
+        if snapshot is None:
+            raise VmCreateError("Linked clones need a snapshot of template %s" % opts.template)
+
+    templates[key] = (template, props.get('config.hardware.device'), snapshot)
+    return templates[key]
+
+def getDatastoreByName(si,name):
+    for row in retrieveProperties(si,"Datastore",['name']):
+        if row['name'] == name:
+            return row['mor']
+    return None
+
+def buildCloneSpec(si,opts,vmSpec,resourcePool,templates):
+    """
+    Turn the spec of a new virtual machine into a clone of opts.template.
+    The cpu, memory, annotation and nics of the spec are applied as a
+    reconfigure of the clone, its nics replacing the template's; the
+    disks come from the template.  Linked clones share the template disks
+    through a child disk backing on the template datastore, full clones
+    are copied to the datastore of the spec.
+
+    @returns: 2-tuple of (template vm, VirtualMachineCloneSpec)
+    """
+    template, devices, snapshot = getCloneSource(si,opts,templates)
+
+    configSpec = VirtualMachineConfigSpec()
+    configSpec.setNumCPUs(vmSpec.getNumCPUs())
+    configSpec.setMemoryMB(vmSpec.getMemoryMB())
+    configSpec.setAnnotation(vmSpec.getAnnotation())
+    deviceChange = []
+    for device in devices or []:
+        if isinstance(device, VirtualEthernetCard):
+            nicSpec = VirtualDeviceConfigSpec()
+            nicSpec.setOperation(VirtualDeviceConfigSpecOperation.remove)
+            nicSpec.setDevice(device)
+            deviceChange.append(nicSpec)
+    nicKey = -1
+    for nicSpec in vmSpec.getDeviceChange() or []:
+        if isinstance(nicSpec.getDevice(), VirtualEthernetCard):
+            # Negative keys can not collide with the template's devices
+            nicSpec.getDevice().setKey(nicKey)
+            nicKey = nicKey - 1
+            deviceChange.append(nicSpec)
+    configSpec.setDeviceChange(deviceChange)
+
+    relocateSpec = VirtualMachineRelocateSpec()
+    relocateSpec.setPool(resourcePool.getMOR())
+    if opts.linked:
+        relocateSpec.setDiskMoveType("createNewChildDiskBacking")
+    else:
+        dsName = vmSpec.getFiles().getVmPathName().strip("[] ")
+        datastore = getDatastoreByName(si,dsName)
+        if datastore is None:
+            raise VmCreateError("Unable to find datastore %s" % dsName)
+        relocateSpec.setDatastore(datastore)
+
+    cloneSpec = VirtualMachineCloneSpec()
+    cloneSpec.setLocation(relocateSpec)
+    cloneSpec.setConfig(configSpec)
+    cloneSpec.setSnapshot(snapshot)
+    cloneSpec.setPowerOn(False)
+    cloneSpec.setTemplate(False)
+    return template, cloneSpec
+
+def submitCreateTask(vmFolder,resourcePool,name,vmSpec,clone=None):
+    """
+    Start creating virtual machine name, as a clone when clone is a
+    (template, clone spec) pair from buildCloneSpec
+    """
+    if clone:
+        template, cloneSpec = clone
+        return template.cloneVM_Task(vmFolder, name, cloneSpec)
+    return vmFolder.createVM_Task(vmSpec, resourcePool, None)
+
+def getVmMacAddresses(si,macIndex):
+    """
+    Add the owner of the mac address of every nic configured on a
+    server to macIndex, using one PropertyCollector call
+    """
+    server = si.getServerConnection().getUrl().getHost()
+    for vm in retrieveProperties(si,"VirtualMachine",['name','config.hardware.device']):
+        for device in vm.get('config.hardware.device') or []:
+            if isinstance(device, VirtualEthernetCard) and device.getMacAddress():
+                macIndex.setdefault(device.getMacAddress().lower(), []).append(('vm', server, vm.get('name')))
+
+def getCobblerMacAddresses(cblr_master,macIndex):
+    """
+    Add the owner of the mac address of every interface of every Cobbler
+    system to macIndex, using one XML-RPC call
+    """
+    conn = ServerProxy("http://%s/cobbler_api" % cblr_master)
+    try:
+        systems = conn.get_systems()
+    except (socket.gaierror, socket.error, ProtocolError, Fault), reason:
+        raise VmCreateError("Unable to connect to %s (%s) " % (cblr_master, reason))
+    for system in systems:
+        for interface in (system.get('interfaces') or {}).values():
+            if interface.get('mac_address'):
+                macIndex.setdefault(interface['mac_address'].lower(), []).append(('cobbler', cblr_master, system['name']))
+
+def buildMacIndex(si,options,masters):
+    """
+    Return a dict of every mac address in use on this server, the
+    --mac-hosts servers and the given Cobbler masters, mapped to the
+    list of its (kind, server, name) owners
+    """
+    macIndex = {}
+    getVmMacAddresses(si,macIndex)
+    if options.mac_hosts:
+        for server in getServerList(options.mac_hosts):
+            hostSi = openServiceInstance(server,options.username,options.password,options)
+            try:
+                getVmMacAddresses(hostSi,macIndex)
+            finally:
+                closeServiceInstance(hostSi,options)
+    for master in masters:
+        if master:
+            getCobblerMacAddresses(master,macIndex)
+    return macIndex
+
+def getManualMacAddresses(vmSpec):
+    """
+    Return the manually assigned mac addresses of a vm spec, lower case
+    """
+    macs = []
+    for deviceSpec in vmSpec.getDeviceChange() or []:
+        nic = deviceSpec.getDevice()
+        if isinstance(nic, VirtualEthernetCard) and nic.getAddressType() == "manual":
+            macs.append(nic.getMacAddress().lower())
+    return macs
+
+def checkMacConflicts(macIndex,name,vmSpec,pruned,server):
+    """
+    Check the manual macs of a new vm against the index and claim them,
+    so later vms of the same run conflict with it too.  A vm may keep the
+    macs of its own Cobbler system, and of its old self on server when
+    pruned; any other owner is a conflict.
+
+    @returns: list of conflict messages
+    """
+    conflicts = []
+    for mac in getManualMacAddresses(vmSpec):
+        taken = False
+        for kind, owner, ownerName in macIndex.get(mac, []):
+            if ownerName == name and (kind == 'cobbler' or (kind == 'vm' and pruned and owner == server)):
+                continue
+            if kind == 'new':
+                conflicts.append("%s is also assigned to %s in this run" % (mac, ownerName))
+            else:
+                conflicts.append("%s is already used by %s %s on %s" % (mac, kind, ownerName, owner))
+            taken = True
+        if not taken:
+            macIndex.setdefault(mac, []).append(('new', None, name))
+    return conflicts
+
+def readManifest(path):
+    """
+    Read a list of virtual machine definitions from a YAML, JSON or CSV
+    manifest.  Each entry uses the option names of the create action as
+    keys (name, cpucount, memorysize, disk, nic, cblr_master, ...).  In
+    CSV files and plain strings the disk and nic lists are ';' separated.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    f = open(path)
+    try:
+        if ext in ('.yaml', '.yml'):
+            import yaml
+            entries = yaml.safe_load(f)
+        elif ext == '.json':
+            if json is None:
+                raise ImportError("JSON manifests need the json or simplejson module")
+            entries = json.load(f)
+        elif ext == '.csv':
+            import csv
+            entries = [dict([(k, v) for k, v in row.items() if v]) for row in csv.DictReader(f)]
+        else:
+            raise ValueError("unknown manifest type %s" % ext)
+    finally:
+        f.close()
+
+    if isinstance(entries, dict):
+        entries = entries.get('vms')
+    if not isinstance(entries, list):
+        raise ValueError("manifest must contain a list of virtual machines")
+    for entry in entries:
+        if not entry.get('name'):
+            raise ValueError("every manifest entry needs a name")
+    return entries
+
+def manifestOptions(options,entry):
+    """
+    Return a copy of the command line options overridden by a manifest entry
+    """
+    opts = copy.copy(options)
+    for key, value in entry.items():
+        if key in ('disk', 'nic'):
+            if isinstance(value, basestring):
+                value = [v.strip() for v in value.split(';') if v.strip()]
+            elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                value = [str(value)]
+            elif isinstance(value, list) and not [v for v in value if isinstance(v, (list, dict, bool))]:
+                value = [str(v) for v in value if v is not None]
+            else:
+                raise ValueError("%s must be a value or a list of values, not %r" % (key, value))
+        elif key in ('cpucount', 'memorysize', 'scsiControllers'):
+            value = int(value)
+        elif key in ('genmac', 'prune', 'on', 'linked') and isinstance(value, basestring):
+            value = value.lower() in ('1', 'yes', 'true', 'on')
+        setattr(opts, key, value)
+    return opts
+
+def createVmsFromManifest(si,options,entries):
+    """
+    Create every virtual machine of a manifest in one session.  Specs are
+    built up front, then the prune, create and power on tasks of all vms
+    run as a pipeline with up to options.parallel tasks in flight.
+    """
+    resourcePool = getResourcePools(si)[0]
+    datacenter = getDatacenters(si)[0]
+    vmFolder = datacenter.getVmFolder()
+
+    results = {}
+    names = []
+    jobs = []
+
+    def powerOnJob(name, vmMor):
+        vm = MorUtil.createExactManagedObject(si.getServerConnection(),vmMor)
+        def done(label, state, error, result):
+            if state == "success":
+                results[name] = ("OK", "created and powered ON")
+            else:
+                results[name] = ("FAILED", "created, power on failed: %s" % error)
+        return (name, lambda: vm.powerOnVM_Task(None), done)
+
+    def createJob(name, vmSpec, clone, powerOn):
+        def done(label, state, error, result):
+            if state != "success":
+                results[name] = ("FAILED", "create failed: %s" % error)
+                if placer:
+                    placer.release(name)
+                return []
+            print "%s is being created" % name
+            results[name] = ("OK", "created")
+            forgetVirtualMachineNameIndex(vmFolder)
+            if powerOn and result:
+                return [powerOnJob(name, result)]
+        return (name, lambda: submitCreateTask(vmFolder, resourcePool, name, vmSpec, clone), done)
+
+    def pruneJob(name, vm, nextJob):
+        def destroyed(label, state, error, result):
+            if state != "success":
+                results[name] = ("FAILED", "prune failed: %s" % error)
+                return []
+            print "%s has been deleted" % name
+            forgetVirtualMachineNameIndex(vm)
+            return [nextJob]
+        destroyJob = (name, lambda: vm.destroy_Task(), destroyed)
+        if "PowerOffVM_Task" in vm.getDisabledMethod():
+            return destroyJob
+
+        # A running vm is powered off as a task of its own first
+        def poweredOff(label, state, error, result):
+            if state != "success":
+                results[name] = ("FAILED", "prune power off failed: %s" % error)
+                return []
+            return [destroyJob]
+        return (name, lambda: vm.powerOffVM_Task(), poweredOff)
+
+    # A malformed entry only fails its own vm
+    entryOptions = []
+    for i, entry in enumerate(entries):
+        name = entry.get('name') or "entry %d" % (i + 1)
+        names.append(name)
+        try:
+            entryOptions.append(manifestOptions(options, entry))
+        except (ValueError, TypeError), reason:
+            results[name] = ("FAILED", "invalid manifest entry (%s)" % reason)
+
+    masters = dict([(opts.cblr_master, True) for opts in entryOptions]).keys()
+    for master in masters:
+        if master:
+            try:
+                fetchCobblerSystems(master,[opts.name for opts in entryOptions if opts.cblr_master == master])
+            except VmCreateError:
+                # Reported for every vm of this master below
+                pass
+
+    # Built on the first vm with manual macs, vms with generated ones can
+    # not conflict and do not need the inventory and Cobbler reads
+    macIndex = None
+
+    # One placer for the whole manifest keeps its reservations consistent
+    placer = None
+    if options.placement:
+        placer = DatastorePlacer(si,options.placement,resourcePool,options.max_provisioned)
+
+    # Clone sources must not be deleted by the prune of another entry
+    pruned = dict([(opts.name, True) for opts in entryOptions if opts.prune])
+    templates = {}
+    for opts in entryOptions:
+        clone = None
+        try:
+            vmSpec = buildVmSpec(opts,placer)
+            if opts.template and opts.template in pruned:
+                raise VmCreateError("Unable to clone %s, it is pruned by this manifest" % opts.template)
+            if opts.template:
+                clone = buildCloneSpec(si,opts,vmSpec,resourcePool,templates)
+        except (VmCreateError, ValueError, TypeError), reason:
+            results[opts.name] = ("FAILED", str(reason).strip())
+            if placer:
+                placer.release(opts.name)
+            continue
+
+        if options.mac_check and getManualMacAddresses(vmSpec):
+            if macIndex is None:
+                try:
+                    macIndex = buildMacIndex(si,options,masters)
+                except VmCreateError, reason:
+                    print reason
+                    sys.exit(1)
+            conflicts = checkMacConflicts(macIndex,opts.name,vmSpec,opts.prune,
+                                          si.getServerConnection().getUrl().getHost())
+            if conflicts:
+                results[opts.name] = ("FAILED", "; ".join(conflicts))
+                if placer:
+                    placer.release(opts.name)
+                continue
+
+        job = createJob(opts.name, vmSpec, clone, opts.on)
+        if opts.prune:
+            vm = getVirtualMachineByName(si,opts.name)
+            if vm:
+                job = pruneJob(opts.name, vm, job)
+        jobs.append(job)
+
+    runTasks(si,jobs,options.parallel)
+
+    FORMAT = '%-22s %-7s %s'
+    print
+    print FORMAT % ('VM Name', 'Result', 'Detail')
+    print FORMAT % ('=' * 22, '=' * 7, '=' * 30)
+    for name in names:
+        result, detail = results.get(name, ("FAILED", "not submitted"))
+        print FORMAT % (name, result, detail)
+
+def getCommandLineOpts(argv=None):
+    """
+    Parses command line options, sys.argv unless argv is given
 
     @returns: 3-tuple of (parser, options, args)
     """
@@ -573,19 +2191,27 @@ def getCommandLineOpts():
     parser.set_defaults(autostart=True)
     parser.set_defaults(heartbeat=False)
     parser.set_defaults(scsiType='sas')
+    parser.set_defaults(scsiControllers=1)
+    parser.set_defaults(diskLayout='roundrobin')
+    parser.set_defaults(diskProvisioning='thin')
     parser.set_defaults(nicType='e1000')
     parser.set_defaults(cpucount=2)
     parser.set_defaults(memorysize=2048)
     parser.set_defaults(guestos='rhel5_64Guest')
     parser.set_defaults(annotation='')
     parser.set_defaults(datastore='datastore1')
+    parser.set_defaults(parallel=1)
+    parser.set_defaults(workers=8)
+    parser.set_defaults(mac_check=True)
+    parser.set_defaults(listen=DAEMON_ADDRESS)
 
     # Hypervisor Config Options
 
     # Required Options
-    parser.add_option('-s', '--server',   dest='server',        action='store',       help='VMware hypervisor')
+    parser.add_option('-s', '--server',   dest='server',        action='store',       help='VMware hypervisor, a comma separated list or @<hosts file> for -q and -m')
     parser.add_option('-u', '--username', dest='username',      action='store',       help='VMware hypervisor username')
     parser.add_option('-p', '--password', dest='password',      action='store',       help='VMware hypervisor password')
+    parser.add_option('--session-cache',  dest='session_cache', action='store_true',  help='Reuse the session cookie cached in %s' % SESSION_CACHE_DIR)
 
     # Managed Objects
     parser.add_option('-D',               dest='datacenter',    action='store_true',  help='Datacenter managed object')
@@ -598,10 +2224,15 @@ def getCommandLineOpts():
 
     # Actions
     parser.add_option('-q', '--query',    dest='query',         action='store_true',  help='Query')
+    parser.add_option('--cache-max-age',  dest='cache_max_age', action='store',       help='Answer queries from a local inventory snapshot refreshed when older than <seconds>', metavar="<seconds>", type="int")
     parser.add_option('-d', '--delete',   dest='delete',        action='store_true',  help='Delete')
     parser.add_option('-c', '--create',   dest='create',        action='store_true',  help='Create')
     parser.add_option('-m', '--modify',   dest='modify',        action='store_true',  help='Modify')
     parser.add_option('--prune',          dest='prune',         action='store_true',  help='Prune')
+    parser.add_option('--batch',          dest='batch',         action='store',       help='Create every vm listed in a YAML, JSON or CSV manifest', metavar="<file>")
+    parser.add_option('--template',       dest='template',      action='store',       help='Clone the new vm from this vm or template (needs vCenter)', metavar="<vm name>")
+    parser.add_option('--snapshot',       dest='snapshot',      action='store',       help='Clone from this snapshot of the template', metavar="<snapshot name>")
+    parser.add_option('--linked',         dest='linked',        action='store_true',  help='Make a linked clone sharing the template disks (default snapshot: current)')
 
     # Filters
     parser.add_option('--all',            dest='all',           action='store_true',  help='Select all')
@@ -612,10 +2243,15 @@ def getCommandLineOpts():
     parser.add_option('--on',             dest='on',            action='store_true',  help='Set Power On')
     parser.add_option('--off',            dest='off',           action='store_true',  help='Set Power Off')
     parser.add_option('--reset',          dest='reset',         action='store_true',  help='Set Power Reset')
+    parser.add_option('--parallel',       dest='parallel',      action='store',       help='Number of power tasks in flight with --all (default: 1)', type="int")
+    parser.add_option('--workers',        dest='workers',       action='store',       help='Number of hypervisors handled in parallel with several -s servers (default: 8)', type="int")
+    parser.add_option('--ordered',        dest='ordered',       action='store_true',  help='Follow the host autostart start order with --all')
 
     # Cobbler Options
     parser.add_option('--master',         dest='cblr_master',   action='store',       help='Cobbler master')
     parser.add_option('--genmac',         dest='genmac',        action='store_true',  help='Generate VMware MAC based on ip address')
+    parser.add_option('--no-mac-check',   dest='mac_check',     action='store_false', help='Skip checking manual MACs against the ESX and Cobbler inventories')
+    parser.add_option('--mac-hosts',      dest='mac_hosts',     action='store',       help='Other hypervisors whose MACs new vms must not reuse, a comma separated list or @<hosts file>')
 
     # Hypervisor Config Options
     parser.add_option('--auto-start',     dest='autostart',     action='store_true',  help='Enable Auto Start')
@@ -631,21 +2267,34 @@ def getCommandLineOpts():
     parser.add_option('--memory-size',    dest='memorysize',    action='store',       help='Amount of RAM in MB (default: 2048)',  type="int")
     parser.add_option('--guest-os',       dest='guestos',       action='store',       help='Guest OS short name rhel5_64Guest, freebsd64Guest, solaris10_64Guest (default: rhel5_64Guest)')
     parser.add_option('--scsi-type',      dest='scsiType',      action='store',       help='Chose one of the following scsi controller types (Default: sas, paravirt, buslogic, parallel)', choices=('sas','paravirt','buslogic','parallel'))
+    parser.add_option('--data-scsi-type', dest='dataScsiType',  action='store',       help='Scsi controller type of the controllers after the first (Default: --scsi-type)', choices=('sas','paravirt','buslogic','parallel'))
+    parser.add_option('--scsi-controllers', dest='scsiControllers', action='store',   help='Number of scsi controllers the disks are spread over (Default: 1, max: %d)' % MAX_SCSI_CONTROLLERS, type="int")
+    parser.add_option('--disk-layout',    dest='diskLayout',    action='store',       help='Spread disks over the controllers in turn or by role (Default: roundrobin, role)', choices=('roundrobin','role'))
+    parser.add_option('--disk-provisioning', dest='diskProvisioning', action='store', help='Provisioning of disks without a mode (Default: thin, lazy-zero, eager-zero)', choices=DISK_PROVISIONING.keys())
     parser.add_option('--nic-type',       dest='nicType',       action='store',       help='Chose one of the following nic types (Default: e1000, vmxnet2, vmxnet3)', choices=('e1000','vmxnet2','vmxnet3'))
     parser.add_option('--notes',          dest='annotation',    action='store',       help='Virtual Machine annotations (default: blank)')
-    parser.add_option('--disk',           dest='disk',          action='append',      help='Virtual disk size in Gb.',                                   metavar="<size>", nargs=1)
+    parser.add_option('--disk',           dest='disk',          action='append',      help='Virtual disk size in Gb, with an optional role (%s) and thin, lazy-zero or eager-zero mode' % ', '.join(DISK_ROLES), metavar="<size>[:<role>][:<mode>]", nargs=1)
     parser.add_option('--nic',            dest='nic',           action='append',      help='MAC address (manually assigned or blank for esx generated)', metavar="<port group>,<mac address>")
     parser.add_option('--datastore',      dest='datastore',     action='store',       help='Datastore name (default: Storage1)')
+    parser.add_option('--placement',      dest='placement',     action='store',       help='Pick the datastore of the vm and of each disk by policy (mostfree, leastlatency, spread)', choices=('mostfree','leastlatency','spread'))
+    parser.add_option('--max-provisioned', dest='max_provisioned', action='store',    help='Skip datastores provisioned beyond this ratio of their capacity with --placement (e.g. 1.5)', type="float")
+
+    # Daemon Options
+    parser.add_option('--daemon',         dest='daemon',        action='store_true',  help='Serve forwarded command lines over HTTP/JSON with warm sessions')
+    parser.add_option('--listen',         dest='listen',        action='store',       help='Daemon listen address (default: %s)' % DAEMON_ADDRESS, metavar="<host>:<port>")
+    parser.add_option('--profile',        dest='profile',       action='store_true',  help='Print the time spent in start-up, connects and every SOAP call at exit')
+    parser.add_option('--profile-out',    dest='profile_out',   action='store',       help='Write the raw --profile trace as JSON', metavar="<file>")
 
-    options, args = parser.parse_args()
+    options, args = parser.parse_args(argv)
     
     return parser, options, args
 
-def main():
-
-    parser, options, args = getCommandLineOpts()
+def checkCommandLineOpts(parser, options):
+    """
+    Validate the command line options
 
-    # Check command line options
+    @returns: 2-tuple of (username, password), password may be None
+    """
     if options.server is None:
         parser.error("You must provide a server")
 
@@ -656,9 +2305,6 @@ def main():
 
     password = options.password or os.getenv('VMWARE_PASSWORD')
 
-    if password is None:
-        password = getpass.getpass('Enter password for %s: ' % username)
-
     if (options.name and options.uuid):
         parser.error("A single filter must be specified at a time")
         
@@ -670,21 +2316,57 @@ def main():
         parser.error("A single action must be specified at a time")
     if options.modify and (options.query or options.create or options.delete):
         parser.error("A single action must be specified at a time")
-    
-    # Get esx service instance
-    si = getServiceInstance(options.server,username,password,options.skipSSL)
+
+    if options.parallel < 1:
+        parser.error("--parallel must be at least 1")
+
+    if options.scsiControllers < 1 or options.scsiControllers > MAX_SCSI_CONTROLLERS:
+        parser.error("--scsi-controllers must be between 1 and %d" % MAX_SCSI_CONTROLLERS)
+
+    if options.batch and not (options.create and options.vm):
+        parser.error("--batch is only supported with -V -c")
+
+    if (options.snapshot or options.linked) and not options.template:
+        parser.error("--snapshot and --linked need --template")
+    if options.template and not (options.create and options.vm):
+        parser.error("--template is only supported with -V -c")
+
+    try:
+        options.servers = getServerList(options.server)
+    except IOError, reason:
+        parser.error("Unable to read hosts file (%s)" % reason)
+    if not options.servers:
+        parser.error("You must provide a server")
+    if len(options.servers) > 1 and not (options.query or options.modify):
+        parser.error("Multiple servers are only supported with -q and -m")
+
+    if options.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    if options.profile_out and json is None:
+        parser.error("--profile-out requires the json or simplejson module")
+
+    # Kept for connections opened later in the run, e.g. by --mac-hosts
+    options.username = username
+    options.password = password
+
+    return username, password
+
+def runCommand(si, options):
+    """
+    Run the actions selected by the command line options
+    """
+    # Queries may be answered from a local inventory snapshot
+    if options.query and options.cache_max_age is not None:
+        useInventorySnapshot(si,options.cache_max_age)
 
     # Query Datacenter
     if options.query and options.datacenter:
-        dcs = getDatacenters(si)
-        if dcs:
-            listDatacenters(dcs)
+        listDatacenters(si)
 
     # Query Host Systems
     if options.query and options.host:
-        hss = getHostSystems(si)
-        if hss:
-            listHostSystems(si,hss)
+        listHostSystems(si)
 
     # Modify Host Systems
     if options.modify and options.host:
@@ -699,9 +2381,7 @@ def main():
                                    
     # Query Resource Pools
     if options.query and options.resource:
-        rps = getResourcePools(si)
-        if rps:
-            listResourcePools(rps)
+        listResourcePools(si)
 
     if options.query and options.license:
         listLicenses(si)
@@ -710,17 +2390,15 @@ def main():
     if options.query and options.name and options.vm:
         vm = getVirtualMachineByName(si,options.name)
         if vm:
-            listVirtualMachines(vm)
+            listVirtualMachines(si,vm)
     # Query Virtual Machine by uuid
     elif options.query and options.uuid and options.vm:
         vm = getVirtualMachineByUUID(si,options.uuid)
         if vm:
-            listVirtualMachines(vm)
+            listVirtualMachines(si,vm)
     # Query all Virtual Machines
     elif options.query and options.vm:
-        vms = getVirtualMachines(si)
-        if vms:
-            listVirtualMachines(vms)
+        listVirtualMachines(si)
 
     # Modify Virtual Machine power state by name
     if options.name and options.power and options.modify:
@@ -741,6 +2419,14 @@ def main():
         elif vm and options.on:
             powerOnVm(vm)
     # Modify power state for all Virual Machines on a host
+    elif options.all and options.power and options.modify and (options.parallel > 1 or options.ordered):
+        vms = getVirtualMachines(si)
+        if vms and options.reset:
+            powerAllVmsConcurrently(si,vms,"reset",options.parallel,options.ordered)
+        elif vms and options.off:
+            powerAllVmsConcurrently(si,vms,"off",options.parallel,options.ordered)
+        elif vms and options.on:
+            powerAllVmsConcurrently(si,vms,"on",options.parallel,options.ordered)
     elif options.all and options.power and options.modify:
         vms = getVirtualMachines(si)
         if vms and options.reset:
@@ -760,133 +2446,62 @@ def main():
         if vm:
             deleteVm(vm)
 
+    # Create VMs from a manifest
+    if options.create and options.vm and options.batch:
+        try:
+            entries = readManifest(options.batch)
+        except (IOError, ValueError, ImportError), reason:
+            print "Unable to read manifest %s (%s)" % (options.batch, reason)
+            sys.exit(1)
+        createVmsFromManifest(si,options,entries)
+
     # Create VMs
-    if options.create and options.vm:
+    elif options.create and options.vm:
         resourcePool = getResourcePools(si)[0]
         datacenter = getDatacenters(si)[0]
         vmFolder = datacenter.getVmFolder()
 
-        # Create virtual devices
-        configSpecs = []
-        scsiBusKey = 0
-        scsiBusNum = 0      # Limited to 3 ScsiControllers (i think)
-        diskKey = 0
-        diskUnitNum = 0
-        diskMode = "persistent" # Changes are immediately and permanently written to the virtual disk.
-        nicKey = 0
-        RESERVED_UNITNUM = 7
-        SUPPORTED_HYPERVISORS = ['vmware']
-
-        # If prune is selected delete the vm prior to creating it
-        if options.create and options.vm and options.prune:
-            try:
-                vm = getVirtualMachineByName(si,options.name)
-                deleteVm(vm)
-            except IndexError:
-                pass
-
-        # Pull the Virtual hardware info from Cobbler
-        if options.cblr_master:
-
-            # Standard XML-RPC proxy
-            conn = ServerProxy("http://%s/cobbler_api" % options.cblr_master)
-            try:
-                # Get the system from Cobbler
-                server = conn.get_system_for_koan(options.name)
-            except (socket.gaierror, ProtocolError), reason:
-                print "Unable to connect to %s (%s) " % (options.cblr_master, reason)
-                sys.exit(1)
-
-            if not server:
-                print "Unable to get system information for %s (exiting) " % (options.name)
-                sys.exit(1)
-
-            virt_type = server.get("virt_type")
-            if virt_type not in SUPPORTED_HYPERVISORS:
-                print "Unsupported virt type %s (exiting)" % virt_type
-                sys.exit(1)
-
-            virt_bridge = server.get("virt_bridge",None)
-            virt_cpus = server.get("virt_cpus",None)
-            virt_ram = server.get("virt_ram",None)
-            virt_type = server.get("virt_type",None)
-            comment = server.get("comment",None)
-
-            virt_path = server.get("virt_path",None)
-            virt_file_size = str(server.get("virt_file_size",None))
-
-            if virt_file_size and virt_path:
-                scsiSpec = createScsiSpec(scsiBusKey,scsiBusNum,options.scsiType)
-                configSpecs.append(scsiSpec)
-
-                for disk in virt_file_size.split(','):
-                    # Convert gigabytes to kilobytes
-                    size = (int(disk) * 1024 * 1024)
-                    diskSpec = createDiskSpec(scsiBusKey,diskKey,diskUnitNum,size,diskMode,virt_path)
-                    configSpecs.append(diskSpec)
-                    diskKey = diskKey + 1
-                    diskUnitNum = diskUnitNum + 1
-                    # Skip the unit number assigned to the scsi controller (7)
-                    if diskUnitNum == RESERVED_UNITNUM:
-                        diskUnitNum = diskUnitNum + 1
-
-            interfaces = server.get("interfaces", None)
-            if interfaces:
-                for k in sorted(interfaces.iterkeys()):
-                    if k.find(":") == -1 and k.find(".") == -1:
-
-                        # Generate VMware MAC based on IP
-                        if (options.genmac and k == "eth1"):
-                            interfaces[k]["mac_address"] = ipAddressToVMwareMac(interfaces[k]["ip_address"])
-
-                        netName = interfaces[k]["virt_bridge"]
-                        macAddress = interfaces[k]["mac_address"]
-                        nicSpec = createNicSpec(nicKey,netName,macAddress,options.nicType)
-                        configSpecs.append(nicSpec)
-                        nicKey = nicKey + 1
-
-            vmSpec = createVmSpec(options.name,virt_cpus,virt_ram,options.guestos,comment,virt_path,configSpecs)
-
-        # Use Command line options for Virtual Hardware options
-        else: 
-
-            if options.disk:
-                scsiSpec = createScsiSpec(scsiBusKey,scsiBusNum,options.scsiType)
-                configSpecs.append(scsiSpec)
-
-                # Limited to 15 virtual disks per ScsiController
-                for disk in options.disk:
-                    size = (int(disk) * 1024 * 1024)
-                    diskSpec = createDiskSpec(scsiBusKey,diskKey,diskUnitNum,size,diskMode,options.datastore)
-                    configSpecs.append(diskSpec)
-                    diskKey = diskKey + 1
-                    diskUnitNum = diskUnitNum + 1
-                    # Skip the unit number assigned to the scsi controller (7)
-                    if diskUnitNum == RESERVED_UNITNUM:
-                        diskUnitNum = diskUnitNum + 1
-
-            if options.nic:
-                for nic in options.nic:
-                    try:
-                        netName, macAddress = nic.split(',',1)
-                    except ValueError:
-                        netName = nic
-                        macAddress = None
-                    nicSpec = createNicSpec(nicKey,netName,macAddress,options.nicType)
-                    configSpecs.append(nicSpec)
-                    nicKey = nicKey + 1
+        clone = None
+        try:
+            placer = None
+            if options.placement:
+                placer = DatastorePlacer(si,options.placement,resourcePool,options.max_provisioned)
+            vmSpec = buildVmSpec(options,placer)
+            if options.template:
+                clone = buildCloneSpec(si,options,vmSpec,resourcePool,{})
+            if options.mac_check and getManualMacAddresses(vmSpec):
+                macIndex = buildMacIndex(si,options,[options.cblr_master])
+                conflicts = checkMacConflicts(macIndex,options.name,vmSpec,options.prune,
+                                              si.getServerConnection().getUrl().getHost())
+                if conflicts:
+                    for conflict in conflicts:
+                        print conflict
+                    sys.exit(1)
+        except VmCreateError, reason:
+            print reason
+            sys.exit(1)
 
-            vmSpec = createVmSpec(options.name,options.cpucount,options.memorysize,options.guestos,options.annotation,options.datastore,configSpecs)
+        # If prune is selected delete the vm right before creating it, once
+        # the new one is known to be valid
+        if options.prune:
+            vm = getVirtualMachineByName(si,options.name)
+            if vm:
+                deleteVm(vm)
 
         try:
-            # Call the createVM_Task method on the vm folder
-            task = vmFolder.createVM_Task(vmSpec, resourcePool, None)
+            # Call createVM_Task on the vm folder, or CloneVM_Task on the template
+            task = submitCreateTask(vmFolder, resourcePool, options.name, vmSpec, clone)
         except InvalidDatastore, reason:
             print "Unable to create to vm %s (%s) " % (options.name, reason)
             sys.exit(1)
+        except NotSupported, reason:
+            # Standalone ESX hosts do not implement CloneVM_Task
+            print "Unable to clone vm %s from %s (%s) " % (options.name, options.template, reason)
+            sys.exit(1)
 
         try:
-            if task.waitForMe() == "success":
+            if waitForTask(task) == "success":
+                forgetVirtualMachineNameIndex(vmFolder)
                 print "%s is being created" % options.name
             else:
                 print "%s was not created" % options.name
@@ -894,8 +2509,487 @@ def main():
             print "Unable to create to vm %s (%s) " % (options.name, reason)
             sys.exit(1)
 
-            
-    si.getServerConnection().logout()
+def getServerList(server):
+    """
+    Expand the -s argument into a list of servers.  It is either a comma
+    separated list or @<file> naming a hosts file with one server per
+    line, blank lines and # comments are ignored.
+    """
+    if server.startswith('@'):
+        f = open(server[1:])
+        try:
+            lines = [l.split('#',1)[0].strip() for l in f.readlines()]
+        finally:
+            f.close()
+        return [l for l in lines if l]
+    return [s.strip() for s in server.split(',') if s.strip()]
+
+class Profiler:
+    """
+    Records the wall time of the phases of a run (JVM start-up, connects)
+    and of every SOAP call made through a profiled connection
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.jvmStarted = ManagementFactory.getRuntimeMXBean().getStartTime() / 1000.0
+        self.phases = [{'phase': 'jvm-startup', 'start': self.jvmStarted,
+                        'seconds': self.started - self.jvmStarted}]
+        self.calls = []
+
+    def phase(self, name, start):
+        self.lock.acquire()
+        try:
+            self.phases.append({'phase': name, 'start': start, 'seconds': time.time() - start})
+        finally:
+            self.lock.release()
+
+    def record(self, soapMsg, start, responseSize):
+        match = SOAP_CALL_PATTERN.search(soapMsg)
+        if match:
+            method, moType, moRef = match.groups()
+        else:
+            method, moType, moRef = 'unknown', None, None
+        self.lock.acquire()
+        try:
+            self.calls.append({'method': method, 'moType': moType, 'moRef': moRef, 'start': start,
+                               'seconds': time.time() - start, 'requestBytes': len(soapMsg),
+                               'responseBytes': responseSize, 'thread': threading.currentThread().getName()})
+        finally:
+            self.lock.release()
+
+    def report(self, summary=True, traceFile=None):
+        """
+        Print the calls grouped by method and managed object type, sorted
+        by cumulative time, and write the raw trace to traceFile
+        """
+        totals = {}
+        for call in self.calls:
+            t = totals.setdefault((call['method'], call['moType'] or ''), [0, 0.0, 0, 0])
+            t[0] = t[0] + 1
+            t[1] = t[1] + call['seconds']
+            t[2] = t[2] + call['requestBytes']
+            t[3] = t[3] + call['responseBytes']
+
+        if summary:
+            out = sys.stderr
+            print >> out, "%-32s %-22s %6s %9s %9s %11s %11s" % ('Method', 'Type', 'Calls', 'Total(s)', 'Avg(ms)', 'Sent', 'Received')
+            for (method, moType), t in sorted(totals.items(), key=lambda item: item[1][1], reverse=True):
+                print >> out, "%-32s %-22s %6d %9.3f %9.1f %11d %11d" % (method, moType, t[0], t[1], t[1] * 1000 / t[0], t[2], t[3])
+            for phase in self.phases:
+                print >> out, "%-55s %9.3f" % (phase['phase'], phase['seconds'])
+            print >> out, "%-55s %9.3f" % ('soap calls (%d)' % len(self.calls), sum([c['seconds'] for c in self.calls]))
+            print >> out, "%-55s %9.3f" % ('total', time.time() - self.jvmStarted)
+
+        if traceFile:
+            f = open(traceFile, 'w')
+            try:
+                f.write(json.dumps({'jvmStart': self.jvmStarted, 'end': time.time(),
+                                    'phases': self.phases, 'calls': self.calls}))
+            finally:
+                f.close()
+
+# Profiler of the current run, set by --profile and --profile-out
+profiler = None
+
+class ProfilingWSClient(WSClient):
+    """
+    vijava SOAP client that reports every request to the profiler.  The
+    response is buffered to be measured, it is parsed from memory.
+    """
+    def __init__(self, url, ignoreCert, profiler):
+        WSClient.__init__(self, url, ignoreCert)
+        self.profiler = profiler
+
+    def post(self, soapMsg):
+        start = time.time()
+        size = 0
+        try:
+            stream = WSClient.post(self, soapMsg)
+            body = ByteArrayOutputStream()
+            buf = jarray.zeros(8192, 'b')
+            n = stream.read(buf)
+            while n != -1:
+                body.write(buf, 0, n)
+                n = stream.read(buf)
+            stream.close()
+            size = body.size()
+            return ByteArrayInputStream(body.toByteArray())
+        finally:
+            self.profiler.record(soapMsg, start, size)
+
+def profileServiceInstance(si,server,skipSSL,profiler):
+    """
+    Swap the SOAP client of a logged in service instance for a
+    ProfilingWSClient carrying over its session cookie and settings
+    """
+    vimService = si.getServerConnection().getVimService()
+    cls = vimService.getClass()
+    wscField = None
+    while cls is not None:
+        try:
+            wscField = cls.getDeclaredField("wsc")
+            break
+        except (Exception, JavaException):
+            cls = cls.getSuperclass()
+    if wscField is None:
+        print "Unable to profile %s, the vijava client is not supported" % server
+        return
+    wscField.setAccessible(True)
+    wsc = wscField.get(vimService)
+
+    profiling = ProfilingWSClient("https://%s/sdk" % server, skipSSL, profiler)
+    # The session cookie and timeouts may live in a base class (SoapClient
+    # in newer vijava), so copy the fields of the whole class chain
+    cls = wsc.getClass()
+    while cls is not None:
+        if cls.isInstance(profiling):
+            for field in cls.getDeclaredFields():
+                if not Modifier.isStatic(field.getModifiers()):
+                    field.setAccessible(True)
+                    field.set(profiling, field.get(wsc))
+        cls = cls.getSuperclass()
+    wscField.set(vimService, profiling)
+
+def openServiceInstance(server,username,password,options):
+    """
+    Connect to server, reusing a cached session when --session-cache is
+    set.  The password is prompted for only when a login is needed.
+    """
+    si = None
+    start = time.time()
+    if options.session_cache:
+        si = loadCachedSession(server,username,options.skipSSL)
+
+    if si is None:
+        if password is None:
+            password = getpass.getpass('Enter password for %s: ' % username)
+            options.password = password
+            start = time.time()
+        si = getServiceInstance(server,username,password,options.skipSSL)
+        if options.session_cache:
+            saveCachedSession(server,username,si)
+
+    if profiler:
+        profiler.phase('connect %s' % server, start)
+        profileServiceInstance(si,server,options.skipSSL,profiler)
+    return si
+
+def closeServiceInstance(si,options):
+    """
+    Log out, except for cached sessions which stay valid for the next
+    invocation
+    """
+    if not options.session_cache:
+        si.getServerConnection().logout()
+
+class ThreadOutput:
+    """
+    sys.stdout replacement that sends the output of each fan-out worker
+    thread to its own buffer and everything else to the wrapped stream
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buffer = StringIO.StringIO()
+
+    def release(self):
+        buffer = self.local.buffer
+        self.local.buffer = None
+        return buffer.getvalue()
+
+    def target(self):
+        """
+        Return the stream the current thread writes to
+        """
+        return getattr(self.local, 'buffer', None) or self.stream
+
+    def write(self, data):
+        self.target().write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+def runOnServers(options,connect,release):
+    """
+    Run the selected actions on every server of options.servers with at
+    most options.workers in parallel.  The output of each server is
+    printed as one block with every line tagged with the server name, and
+    a failing server does not stop the others.
+
+    @returns: number of servers that failed
+    """
+    servers = Queue.Queue()
+    for server in options.servers:
+        servers.put(server)
+    failures = []
+    lock = threading.Lock()
+    stdout = sys.stdout
+    if isinstance(stdout, ThreadOutput):
+        # Already capturing per thread (daemon), the blocks go to the
+        # output of the calling thread
+        output = stdout
+        target = stdout.target()
+    else:
+        output = ThreadOutput(stdout)
+        target = stdout
+
+    def worker():
+        while True:
+            try:
+                server = servers.get_nowait()
+            except Queue.Empty:
+                return
+            output.capture()
+            try:
+                try:
+                    si = connect(server)
+                    try:
+                        runCommand(si, options)
+                    finally:
+                        release(si)
+                except SystemExit, e:
+                    if e.code:
+                        print "Error: exited with %s" % e.code
+                        failures.append(server)
+                except (Exception, JavaException), reason:
+                    print "Error: %s" % reason
+                    failures.append(server)
+            finally:
+                lines = output.release().splitlines()
+                lock.acquire()
+                try:
+                    for line in lines:
+                        target.write("%s: %s\n" % (server, line))
+                    target.flush()
+                finally:
+                    lock.release()
+
+    sys.stdout = output
+    try:
+        threads = []
+        for i in range(min(options.workers, len(options.servers))):
+            t = threading.Thread(target=worker)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+    finally:
+        sys.stdout = stdout
+
+    for server in failures:
+        print "%s: FAILED" % server
+    return len(failures)
+
+# Warm service instances of the daemon keyed by (server, username,
+# password digest)
+daemonSessions = {}
+
+def randomToken():
+    """
+    Return 32 random hex digits
+    """
+    data = jarray.zeros(16, 'b')
+    SecureRandom().nextBytes(data)
+    return ''.join(['%02x' % (b & 0xff) for b in data])
+
+# Salt of the password digests keying daemonSessions, new for every daemon
+daemonSalt = randomToken()
+
+def getDaemonServiceInstance(server,username,password,skipSSL):
+    """
+    Return a warm service instance for the server, logging in again when
+    the cached session is no longer valid.  Sessions are keyed by a salted
+    digest of the password, so only the password that opened a session
+    reuses it; any other one has to log in on its own.
+    """
+    key = (server, username, hashlib.sha256(daemonSalt + password).hexdigest())
+    si = daemonSessions.get(key)
+    if si:
+        try:
+            si.currentTime()
+            return si
+        except (Exception, JavaException):
+            daemonSessions.pop(key, None)
+    si = getServiceInstance(server,username,password,skipSSL)
+    daemonSessions[key] = si
+    return si
+
+def runDaemonCommand(argv,username=None,password=None):
+    """
+    Run one forwarded command line against a warm session
+
+    @returns: 2-tuple of (exit status, captured output)
+    """
+    # sys.stdout and sys.stderr are a ThreadOutput set up by serveCommands
+    sys.stdout.capture()
+    status = 0
+    try:
+        try:
+            parser, options, args = getCommandLineOpts(argv)
+            if options.daemon or options.profile or options.profile_out:
+                parser.error("--daemon and --profile can not be forwarded")
+            options.username = options.username or username
+            options.password = options.password or password
+            username, password = checkCommandLineOpts(parser, options)
+            if password is None:
+                parser.error("You must provide a password")
+
+            # The vm inventory and Cobbler systems may have changed since the last request
+            vmNameIndex.clear()
+            inventorySnapshots.clear()
+            cobblerSystems.clear()
+            if len(options.servers) > 1:
+                connect = lambda server: getDaemonServiceInstance(server,username,password,options.skipSSL)
+                if runOnServers(options,connect,lambda si: None):
+                    status = 1
+            else:
+                si = getDaemonServiceInstance(options.servers[0],username,password,options.skipSSL)
+                runCommand(si, options)
+        except SystemExit, e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                print e.code
+                status = 1
+        except (Exception, JavaException), reason:
+            print "Error: %s" % reason
+            status = 1
+    finally:
+        output = sys.stdout.release()
+    return status, output
+
+class DaemonRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Accepts POST /run with a JSON body of {"argv": [...], "username": ...,
+    "password": ...} and answers {"status": <exit status>, "output": ...}.
+    Requests must carry the token of DAEMON_TOKEN_FILE in X-Daemon-Token.
+    """
+    def do_POST(self):
+        if self.path != '/run':
+            self.send_error(404)
+            return
+        if not tokensEqual(self.headers.getheader('x-daemon-token') or '', self.server.token):
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.getheader('content-length') or 0)
+            request = json.loads(self.rfile.read(length))
+            argv = [str(a) for a in request['argv']]
+        except (ValueError, KeyError, TypeError), reason:
+            self.send_error(400, str(reason))
+            return
+
+        status, output = runDaemonCommand(argv,request.get('username'),request.get('password'))
+        body = json.dumps({'status': status, 'output': output})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def tokensEqual(a, b):
+    """
+    Compare two tokens in a time independent of where they differ
+    """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result = result | (ord(x) ^ ord(y))
+    return result == 0
+
+def writeDaemonToken(token):
+    """
+    Store the client token in DAEMON_TOKEN_FILE, only readable by the
+    user running the daemon; clients must run as the same user
+    """
+    directory = os.path.dirname(DAEMON_TOKEN_FILE)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    tmp = "%s.%d" % (DAEMON_TOKEN_FILE, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    try:
+        os.write(fd, token)
+    finally:
+        os.close(fd)
+    os.chmod(tmp, 0600)
+    os.rename(tmp, DAEMON_TOKEN_FILE)
+
+class DaemonServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serveCommands(address):
+    """
+    Run the resident daemon, keeping hypervisor sessions warm between
+    forwarded commands.  Requests are served concurrently, each in its
+    own thread with its own output and caches.
+    """
+    if json is None:
+        print "The daemon needs the json or simplejson module"
+        sys.exit(1)
+    host, port = address.rsplit(':',1)
+    httpd = DaemonServer((host, int(port)), DaemonRequestHandler)
+    httpd.token = randomToken()
+    writeDaemonToken(httpd.token)
+    print "Serving vmware_cli commands on http://%s/run" % address
+
+    # Every request thread captures its own output
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = ThreadOutput(stdout)
+    try:
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        try:
+            os.unlink(DAEMON_TOKEN_FILE)
+        except OSError:
+            pass
+    for si in daemonSessions.values():
+        try:
+            si.getServerConnection().logout()
+        except (Exception, JavaException):
+            pass
+
+def main():
+    global profiler
+
+    parser, options, args = getCommandLineOpts()
+
+    if options.profile or options.profile_out:
+        profiler = Profiler()
+        atexit.register(profiler.report, options.profile, options.profile_out)
+
+    if options.daemon:
+        serveCommands(options.listen)
+        return
+
+    # Check command line options
+    username, password = checkCommandLineOpts(parser, options)
+
+    # Fan out over several hypervisors
+    if len(options.servers) > 1:
+        if password is None and not options.session_cache:
+            password = getpass.getpass('Enter password for %s: ' % username)
+        connect = lambda server: openServiceInstance(server,username,password,options)
+        release = lambda si: closeServiceInstance(si,options)
+        if runOnServers(options,connect,release):
+            sys.exit(1)
+        return
+
+    # Get esx service instance
+    si = openServiceInstance(options.servers[0],username,password,options)
+
+    runCommand(si, options)
+
+    closeServiceInstance(si,options)
 
 if __name__ == "__main__":
     main()
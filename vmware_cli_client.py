@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Thin client for "vmware_cli.py --daemon"
+#
+# Forwards its command line to the resident daemon so short operations do
+# not pay for a JVM start-up and a fresh login.  When no daemon answers the
+# command is run by vmware_cli.py directly.
+
+import os
+import sys
+import urllib2
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+DAEMON_ADDRESS = os.getenv('VMWARE_CLI_DAEMON', '127.0.0.1:8707')
+VMWARE_CLI = os.getenv('VMWARE_CLI', '/usr/local/bin/vmware_cli.py')
+DAEMON_TOKEN_FILE = os.getenv('VMWARE_CLI_DAEMON_TOKEN', os.path.expanduser('~/.vmware_cli/daemon.token'))
+
+def readToken():
+    """
+    Return the token written by the daemon, None when it is not running
+    as this user
+    """
+    try:
+        f = open(DAEMON_TOKEN_FILE)
+        try:
+            return f.read().strip()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+def forwardCommand(argv):
+    """
+    Send a command line to the daemon and return (status, output)
+    """
+    request = {'argv': argv,
+               'username': os.getenv('VMWARE_USERNAME'),
+               'password': os.getenv('VMWARE_PASSWORD')}
+    token = readToken()
+    if token is None:
+        raise urllib2.URLError("no daemon token in %s" % DAEMON_TOKEN_FILE)
+    http = urllib2.Request('http://%s/run' % DAEMON_ADDRESS, json.dumps(request),
+                           {'X-Daemon-Token': token})
+    response = urllib2.urlopen(http)
+    result = json.loads(response.read())
+    return result['status'], result['output']
+
+def main():
+    try:
+        status, output = forwardCommand(sys.argv[1:])
+    except urllib2.URLError:
+        # No daemon listening or not ours, fall back to a regular invocation
+        os.execv(VMWARE_CLI, [VMWARE_CLI] + sys.argv[1:])
+    sys.stdout.write(output)
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
@@ -12,35 +12,130 @@
 import pywbem
 import os
 import sys
+import pickle
+import random
+import socket
+import threading
+import time
+import Queue
+import BaseHTTPServer
+try:
+   import json
+except ImportError:
+   import simplejson as json
 from optparse import OptionParser
 
-# Dictionary to cache class metadata
-classData = {}
-def friendlyValue(client, instance, propertyName):
-   global classData
+# Where the compiled ValueMap tables are kept between runs
+valueMapCacheFile = os.path.expanduser('~/.vmware_monitor/valuemaps.pickle')
+
+# Dictionary of compiled ValueMap tables keyed by (host build, class name),
+# each mapping property name to a dict of value -> friendly string
+valueMaps = None
+valueMapsChanged = False
+
+# Guards valueMaps, which the poll workers fill while another one saves it
+valueMapsLock = threading.Lock()
+
+# Dictionary to cache the build of each host, keyed by connection url
+hostBuilds = {}
+
+def loadValueMaps():
+   global valueMaps
+   try:
+      f = open(valueMapCacheFile, 'rb')
+      try:
+         valueMaps = pickle.load(f)
+      finally:
+         f.close()
+   except (IOError, EOFError, pickle.UnpicklingError):
+      valueMaps = {}
+
+def saveValueMaps():
+   global valueMapsChanged
+   valueMapsLock.acquire()
+   try:
+      # Only rewrite the cache if we compiled new classes since the last save
+      if not valueMapsChanged:
+         return
+      dir = os.path.dirname(valueMapCacheFile)
+      if not os.path.isdir(dir):
+         os.makedirs(dir)
+      tmp = '%s.%d' % (valueMapCacheFile, os.getpid())
+      f = open(tmp, 'wb')
+      try:
+         pickle.dump(valueMaps, f, pickle.HIGHEST_PROTOCOL)
+      finally:
+         f.close()
+      os.rename(tmp, valueMapCacheFile)
+      valueMapsChanged = False
+   finally:
+      valueMapsLock.release()
+
+def getHostBuild(client):
+   # The ValueMap qualifiers only change with the ESX build, so that is
+   # what the cache is keyed by.  Fall back to the host url if unknown.
+   if client.url not in hostBuilds:
+      build = client.url
+      try:
+         for instance in client.EnumerateInstances('VMware_HypervisorSoftwareIdentity',
+                                                   PropertyList=['VersionString', 'BuildNumber']):
+            build = '%s-%s' % (instance['VersionString'], instance['BuildNumber'])
+            break
+      except pywbem.CIMError:
+         pass
+      hostBuilds[client.url] = build
+   return hostBuilds[client.url]
+
+def compileValueMaps(myClass):
+   # Turn the ValueMap/Values qualifier pairs of a class into dicts
+   tables = {}
+   for propertyName, prop in myClass.properties.items():
+      qualifiers = prop.qualifiers
+      if 'ValueMap' in qualifiers.keys() and 'Values' in qualifiers.keys():
+         vals = qualifiers['Values'].value
+         valmap = qualifiers['ValueMap'].value
+         tables[propertyName] = dict(zip([str(v) for v in valmap], vals))
+   return tables
 
+def friendlyValue(client, instance, propertyName):
+   label = valueLabel(client, instance, propertyName)
+   if label:
+      return ' (' + label + ')'
    # Start out with a default empty string, in case we don't have a mapping
-   mapping = ''
+   return ''
 
-   if instance.classname not in classData:
-      # Fetch the class metadata if we don't already have it in the cache
-      classData[instance.classname] = client.GetClass(instance.classname, IncludeQualifiers=True)
+# Return the ValueMap label(s) of a property value, or an empty string
+def valueLabel(client, instance, propertyName):
+   global valueMapsChanged
 
-   myClass = classData[instance.classname]
+   key = (getHostBuild(client), instance.classname)
+   valueMapsLock.acquire()
+   try:
+      if valueMaps is None:
+         loadValueMaps()
+      tables = valueMaps.get(key)
+   finally:
+      valueMapsLock.release()
+
+   if tables is None:
+      # Fetch the class metadata if we don't already have it in the cache
+      myClass = client.GetClass(instance.classname, IncludeQualifiers=True)
+      tables = compileValueMaps(myClass)
+      valueMapsLock.acquire()
+      try:
+         valueMaps[key] = tables
+         valueMapsChanged = True
+      finally:
+         valueMapsLock.release()
 
-   # Now scan through the qualifiers to look for ValueMap/Values sets
-   qualifiers = myClass.properties[propertyName].qualifiers
-   if 'ValueMap' in qualifiers.keys() and 'Values' in qualifiers.keys():
-      vals = qualifiers['Values'].value
-      valmap = qualifiers['ValueMap'].value
-      value = instance[propertyName]
-      # Find the matching value and convert to the friendly string
-      for i in range(0,len(valmap)-1):
-         if str(valmap[i]) == str(value):
-             mapping = ' ('+vals[i]+')'
-             break
+   table = tables.get(propertyName)
+   if not table:
+      return ''
 
-   return mapping
+   value = instance[propertyName]
+   if isinstance(value, list):
+      return ', '.join([table[str(v)] for v in value if str(v) in table])
+   return table.get(str(value), '')
 
 # Clear system event log
 def doClearSEL(client, selInstance):
@@ -49,15 +144,16 @@ def doClearSEL(client, selInstance):
    try:
       print 'Clearing SEL for %s' % (selPath['InstanceID'])
       (retval, outparams) = client.InvokeMethod('ClearLog', selPath)
-      retval = 0
       if retval == 0:
          print 'Completed'
       elif retval == 1:
          print 'Not supported'
       else:
-         print 'Error: ' + retval
+         print 'Error: %s' % retval
+      return retval == 0
    except pywbem.CIMError, arg:
       print 'Exception: ' + arg[1]
+      return False
 
 # Display an instance
 def printInstance(client, instance):
@@ -69,23 +165,251 @@ def printInstance(client, instance):
       print '%30s = %s%s' % (propertyName, instance[propertyName],
                               friendlyValue(client, instance, propertyName))
 
+# Operations that take a namespace argument, so one connection can serve
+# every namespace of a host
+namespaceOperations = ['EnumerateInstances', 'EnumerateInstanceNames', 'GetInstance',
+                       'GetClass', 'EnumerateClasses', 'EnumerateClassNames',
+                       'OpenEnumerateInstances']
+
+# Wraps a shared WBEMConnection for one namespace and records the wall
+# time of every call in the connection manager
+class TimedConnection:
+   def __init__(self, manager, host, connection, namespace):
+      self.manager = manager
+      self.host = host
+      self.connection = connection
+      self.namespace = namespace
+
+   def __getattr__(self, name):
+      attr = getattr(self.connection, name)
+      if not callable(attr):
+         return attr
+      def timedCall(*args, **kwargs):
+         if name in namespaceOperations and 'namespace' not in kwargs:
+            kwargs['namespace'] = self.namespace
+         start = time.time()
+         try:
+            return attr(*args, **kwargs)
+         finally:
+            self.manager.recordCall(self.host, name, time.time() - start)
+      return timedCall
+
+# Keeps one WBEMConnection per host for the life of the process, shared by
+# every namespace so the HTTPS connection and its TLS session are reused,
+# caches the namespace discovery of each host and times every call.  Calls
+# give up after timeout seconds, so a hung host fails its poll instead of
+# holding a worker forever.
+class ConnectionManager:
+   def __init__(self, timeout=None):
+      self.lock = threading.Lock()
+      self.timeout = timeout
+      self.connections = {}
+      self.namespaces = {}
+      self.timings = {}
+
+   def get(self, host, username, password, namespace='root/cimv2'):
+      self.lock.acquire()
+      try:
+         if host not in self.connections:
+            try:
+               connection = pywbem.WBEMConnection('https://'+host, (username, password),
+                                                  namespace, timeout=self.timeout)
+            except TypeError:
+               # pywbem before 0.8 has no timeout, bound the sockets instead
+               socket.setdefaulttimeout(self.timeout)
+               connection = pywbem.WBEMConnection('https://'+host, (username, password),
+                                                  namespace)
+            self.connections[host] = connection
+         return TimedConnection(self, host, self.connections[host], namespace)
+      finally:
+         self.lock.release()
+
+   def getNamespaces(self, host, username, password):
+      if host not in self.namespaces:
+         client = self.get(host, username, password, 'root/interop')
+         list = client.EnumerateInstances('CIM_Namespace', PropertyList=['Name'])
+         self.namespaces[host] = set(map(lambda x: x['Name'], list))
+      return self.namespaces[host]
+
+   def recordCall(self, host, method, seconds):
+      self.lock.acquire()
+      try:
+         count, total = self.timings.get((host, method), (0, 0.0))
+         self.timings[(host, method)] = (count + 1, total + seconds)
+      finally:
+         self.lock.release()
+
+   def printTimings(self):
+      FORMAT = '%-30s %-30s %6s %10s'
+      print FORMAT % ('Host', 'Operation', 'Calls', 'Seconds')
+      print FORMAT % ('=' * 30, '=' * 30, '=' * 6, '=' * 10)
+      for (host, method), (count, total) in sorted(self.timings.items(),
+                                                   key=lambda x: -x[1][1]):
+         print '%-30s %-30s %6d %10.3f' % (host, method, count, total)
+
+# Connection manager shared by everything in this process
+connections = ConnectionManager()
+
 # Get namespaces
 def getNamespaces(options):
-   client = pywbem.WBEMConnection('https://'+options.server,
-                                  (options.username, options.password),
-                                  'root/interop')
-   list = client.EnumerateInstances('CIM_Namespace', PropertyList=['Name'])
-   return set(map(lambda x: x['Name'], list))
+   return connections.getNamespaces(options.server, options.username, options.password)
+
+# Enumerate the instances of a class in batches of batchSize with the WBEM
+# pull operations, handing out each instance as soon as its batch arrives
+# so memory stays bounded however large the class is
+def iterInstances(client, classname, batchSize, propertyList=None):
+   try:
+      result = client.OpenEnumerateInstances(classname, PropertyList=propertyList,
+                                             MaxObjectCount=batchSize)
+   except (AttributeError, pywbem.CIMError):
+      # Older pywbem or a CIMOM without pull support, enumerate in one go
+      result = None
+
+   if result is None:
+      for instance in client.EnumerateInstances(classname, PropertyList=propertyList):
+         yield instance
+      return
+
+   while True:
+      for instance in result.instances:
+         yield instance
+      if result.eos:
+         break
+      result = client.PullInstancesWithPath(result.context, MaxObjectCount=batchSize)
+
+# Where the last SEL record seen on each host and log is remembered
+selStateFile = os.path.expanduser('~/.vmware_monitor/sel_state.pickle')
+
+def loadSelState():
+   try:
+      f = open(selStateFile, 'rb')
+      try:
+         return pickle.load(f)
+      finally:
+         f.close()
+   except (IOError, EOFError, pickle.UnpicklingError):
+      return {}
+
+# Write the state file atomically and make sure it reached the disk
+def saveSelState(state):
+   dir = os.path.dirname(selStateFile)
+   if not os.path.isdir(dir):
+      os.makedirs(dir)
+   tmp = '%s.%d' % (selStateFile, os.getpid())
+   f = open(tmp, 'wb')
+   try:
+      pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+      f.flush()
+      os.fsync(f.fileno())
+   finally:
+      f.close()
+   os.rename(tmp, selStateFile)
+
+# Record IDs are numeric on ESX, compare them as numbers when possible
+def recordId(instance):
+   try:
+      return int(instance['RecordID'])
+   except (TypeError, ValueError, KeyError):
+      return instance.get('RecordID')
+
+# Append a log record to the archive as one line of tab separated values
+def archiveRecord(archive, server, instance):
+   values = ['%s=%s' % (k, instance[k]) for k in sorted(instance.keys())
+             if instance[k] is not None]
+   archive.write('%s\t%s\t%s\n' % (server, instance.classname, '\t'.join(values)))
+
+# Print (and archive) only the log records newer than the high-water mark
+# of their log, then persist the new marks.  A log whose largest record ID
+# is below its mark was cleared elsewhere or started over, so its mark is
+# dropped and all of its records are new.
+def dumpNewLogRecords(client, server, batchSize, archive=None):
+   state = loadSelState()
+   instances = list(iterInstances(client, 'CIM_LogRecord', batchSize))
+   highest = {}
+   for instance in instances:
+      key = (server, instance.get('LogInstanceID') or instance.get('LogName'))
+      id = recordId(instance)
+      if key not in highest or id > highest[key]:
+         highest[key] = id
+   for key in state.keys():
+      # An empty log (None) compares below any mark too
+      if key[0] == server and state[key] is not None and highest.get(key) < state[key]:
+         print 'SEL %s was cleared or restarted, resetting its high-water mark' % key[1]
+         state[key] = None
+   count = 0
+   for instance in instances:
+      key = (server, instance.get('LogInstanceID') or instance.get('LogName'))
+      id = recordId(instance)
+      if key in state and state[key] is not None and id <= state[key]:
+         continue
+      printInstance(client, instance)
+      if archive:
+         archiveRecord(archive, server, instance)
+      if key not in state or state[key] is None or id > state[key]:
+         state[key] = id
+      count = count + 1
+   if archive:
+      archive.flush()
+      os.fsync(archive.fileno())
+   saveSelState(state)
+   return count
+
+# Passes looking for records newer than the last dump before giving up on
+# clearing the SEL
+selClearAttempts = 3
+
+# Forget the high-water mark of a log once it has been cleared, since the
+# record IDs start over
+def resetSelState(server, logInstanceID):
+   state = loadSelState()
+   state[(server, logInstanceID)] = None
+   saveSelState(state)
 
 # Simple function to dump out asset information
-def dumpAssetInformation(server, username, password, clearSEL):
-   client = pywbem.WBEMConnection('https://'+options.server,
-                                  (options.username, options.password),
-                                  'root/cimv2')
-   if clearSEL == True:
+def dumpAssetInformation(server, username, password, clearSEL, stream=False,
+                         batchSize=100, propertyList=None, incremental=False,
+                         archive=None, namespace='root/cimv2'):
+   client = connections.get(server, username, password, namespace)
+   if clearSEL == True and incremental == True:
+      # Only clear once every new record has been printed and persisted
+      # and another pass confirmed nothing newer arrived in the meantime
+      dumpNewLogRecords(client, server, batchSize, archive)
+      for attempt in range(selClearAttempts):
+         if dumpNewLogRecords(client, server, batchSize, archive) == 0:
+            break
+      else:
+         print 'Not clearing SEL, new records are still arriving'
+         return
+      cleared = False
+      for instance in client.EnumerateInstances('CIM_RecordLog'):
+         printInstance(client, instance)
+         if doClearSEL(client, instance):
+            resetSelState(server, instance['InstanceID'])
+            cleared = True
+      if cleared:
+         # Records written right after the clear start the new marks
+         dumpNewLogRecords(client, server, batchSize, archive)
+   elif clearSEL == True:
       for instance in client.EnumerateInstances('CIM_RecordLog'):
          printInstance(client, instance)
          doClearSEL(client, instance)
+   elif incremental == True:
+      count = 0
+      for classname in ['CIM_RecordLog', 'CIM_StorageVolume', 'CIM_EthernetPort']:
+         for instance in iterInstances(client, classname, batchSize, propertyList):
+            printInstance(client, instance)
+            count = count + 1
+      count = count + dumpNewLogRecords(client, server, batchSize, archive)
+      if count == 0:
+         print 'Error: Unable to locate any instances'
+   elif stream == True:
+      count = 0
+      for classname in ['CIM_RecordLog', 'CIM_LogRecord', 'CIM_StorageVolume', 'CIM_EthernetPort']:
+         for instance in iterInstances(client, classname, batchSize, propertyList):
+            printInstance(client, instance)
+            count = count + 1
+      if count == 0:
+         print 'Error: Unable to locate any instances'
    else:
       list = []
       for classname in ['CIM_RecordLog', 'CIM_LogRecord', 'CIM_StorageVolume', 'CIM_EthernetPort']:
@@ -96,6 +420,209 @@ def dumpAssetInformation(server, username, password, clearSEL):
          for instance in list:
             printInstance(client, instance)
 
+# Classes checked on every health poll
+healthClasses = ['CIM_ComputerSystem', 'CIM_NumericSensor', 'CIM_Fan',
+                 'CIM_PowerSupply', 'CIM_Memory', 'CIM_Processor']
+
+# HealthState values that do not need reporting (Unknown, OK)
+healthyStates = [None, 0, 5]
+
+# Latest poll result of each host, {'time', 'duration', 'instances',
+# 'error', 'samples'}.  Metric scrapes are answered from here only.
+pollResults = {}
+
+# File object the samples of every poll are written to as JSON lines
+jsonLinesFile = None
+
+# Serializes the output of the poll workers
+outputLock = threading.Lock()
+
+# Expand a comma separated host list, or @file with one host per line
+def getHostList(hosts):
+   if hosts.startswith('@'):
+      f = open(hosts[1:])
+      try:
+         lines = [l.split('#', 1)[0].strip() for l in f.readlines()]
+      finally:
+         f.close()
+   else:
+      lines = [h.strip() for h in hosts.split(',')]
+   return [l for l in lines if l]
+
+# Poll the health classes of one host and report anything not healthy
+def pollHost(host, username, password):
+   client = connections.get(host, username, password)
+   start = time.time()
+   try:
+      instances = []
+      for classname in healthClasses:
+         instances.extend(client.EnumerateInstances(classname))
+      result = {'time': start, 'duration': time.time() - start,
+                'instances': instances, 'error': None}
+   except Exception, arg:
+      result = {'time': start, 'duration': time.time() - start,
+                'instances': [], 'error': str(arg)}
+   try:
+      result['samples'] = buildSamples(client, host, result)
+   except Exception, arg:
+      # Reading the class metadata failed or timed out, the poll failed
+      result.update({'instances': [], 'error': str(arg)})
+      result['samples'] = buildSamples(client, host, result)
+   pollResults[host] = result
+
+   lines = []
+   if result['error']:
+      lines.append('%s: Error: %s' % (host, result['error']))
+   for instance in result['instances']:
+      if instance.get('HealthState') not in healthyStates:
+         lines.append('%s: %s %s HealthState = %s%s' % (host, instance.classname,
+                      instance.get('ElementName'), instance['HealthState'],
+                      friendlyValue(client, instance, 'HealthState')))
+   lines.append('%s: polled %d instances in %.2fs' % (host, len(result['instances']),
+                result['duration']))
+   outputLock.acquire()
+   try:
+      for line in lines:
+         print line
+      sys.stdout.flush()
+      if jsonLinesFile:
+         writeJsonLines(jsonLinesFile, result['samples'], result['time'])
+      saveValueMaps()
+   finally:
+      outputLock.release()
+
+# Turn a poll result into (metric name, labels, value) samples
+def buildSamples(client, host, result):
+   samples = [('esx_cim_poll_success', {'host': host}, int(result['error'] is None)),
+              ('esx_cim_poll_duration_seconds', {'host': host}, result['duration']),
+              ('esx_cim_poll_timestamp_seconds', {'host': host}, result['time'])]
+   for instance in result['instances']:
+      element = instance.get('ElementName') or instance.get('DeviceID') or ''
+      if instance.get('HealthState') is not None:
+         samples.append(('esx_cim_health_state',
+                         {'host': host, 'class': instance.classname, 'element': element},
+                         instance['HealthState']))
+      if instance.classname.endswith('NumericSensor') and instance.get('CurrentReading') is not None:
+         # Readings are scaled by 10^UnitModifier
+         reading = instance['CurrentReading'] * pow(10.0, instance.get('UnitModifier') or 0)
+         samples.append(('esx_cim_sensor_reading',
+                         {'host': host, 'sensor': element,
+                          'type': valueLabel(client, instance, 'SensorType'),
+                          'units': valueLabel(client, instance, 'BaseUnits')},
+                         reading))
+   return samples
+
+def writeJsonLines(f, samples, timestamp):
+   for name, labels, value in samples:
+      record = dict(labels)
+      record['metric'] = name
+      record['value'] = value
+      record['time'] = timestamp
+      f.write(json.dumps(record) + '\n')
+   f.flush()
+
+# Escape a label value for the Prometheus text format
+def promEscape(value):
+   return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# HELP text of every metric family
+metricHelp = {'esx_cim_poll_success': 'Whether the last CIM poll of the host succeeded',
+              'esx_cim_poll_duration_seconds': 'Duration of the last CIM poll of the host',
+              'esx_cim_poll_timestamp_seconds': 'Start time of the last CIM poll of the host',
+              'esx_cim_health_state': 'CIM HealthState of an element',
+              'esx_cim_sensor_reading': 'Current reading of a numeric sensor in its base units'}
+
+# Render the samples of the latest poll of every host in the Prometheus
+# text exposition format, one contiguous block per metric family
+def renderMetrics():
+   families = {}
+   for host in sorted(pollResults.keys()):
+      for name, labels, value in pollResults[host].get('samples', []):
+         families.setdefault(name, []).append((labels, value))
+   lines = []
+   for name in sorted(families.keys()):
+      lines.append('# HELP %s %s' % (name, metricHelp.get(name, name)))
+      lines.append('# TYPE %s gauge' % name)
+      for labels, value in families[name]:
+         labelText = ','.join(['%s="%s"' % (k, promEscape(labels[k])) for k in sorted(labels.keys())])
+         lines.append('%s{%s} %s' % (name, labelText, repr(float(value))))
+   return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   # Scrapes never reach the CIM broker, they only read pollResults
+   def do_GET(self):
+      if self.path != '/metrics':
+         self.send_error(404)
+         return
+      body = renderMetrics()
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/plain; version=0.0.4')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, format, *args):
+      pass
+
+# Serve /metrics from a background thread
+def startMetricsServer(address):
+   host, port = address.rsplit(':', 1)
+   httpd = BaseHTTPServer.HTTPServer((host, int(port)), MetricsHandler)
+   t = threading.Thread(target=httpd.serve_forever)
+   t.setDaemon(True)
+   t.start()
+   return httpd
+
+# Poll every host on its own schedule with a bounded pool of workers.  A
+# host is only queued again once its previous poll finished, so one slow
+# host never holds up the others, and random jitter spreads the load.
+def pollHosts(hosts, username, password, interval, workers, jitter):
+   work = Queue.Queue()
+   lock = threading.Lock()
+   busy = {}
+   nextPoll = {}
+   for host in hosts:
+      nextPoll[host] = time.time() + random.uniform(0, jitter)
+
+   def worker():
+      while True:
+         host = work.get()
+         try:
+            try:
+               pollHost(host, username, password)
+            except Exception, arg:
+               # Keep the worker alive for the other hosts
+               outputLock.acquire()
+               try:
+                  print '%s: Error: %s' % (host, arg)
+                  sys.stdout.flush()
+               finally:
+                  outputLock.release()
+         finally:
+            lock.acquire()
+            try:
+               del busy[host]
+               nextPoll[host] = time.time() + interval + random.uniform(0, jitter)
+            finally:
+               lock.release()
+
+   for i in range(min(workers, len(hosts))):
+      t = threading.Thread(target=worker)
+      t.setDaemon(True)
+      t.start()
+
+   while True:
+      lock.acquire()
+      try:
+         now = time.time()
+         for host in hosts:
+            if host not in busy and nextPoll[host] <= now:
+               busy[host] = True
+               work.put(host)
+      finally:
+         lock.release()
+      time.sleep(0.5)
+
 if __name__ == '__main__':
    # Some command line argument parsing gorp to make the script a little more
    # user friendly.
@@ -117,23 +644,94 @@ if __name__ == '__main__':
                      default=False)
    parser.add_option('-c', '--clearSEL', dest='clearSEL',
                      help='Clear the IPMI SEL', default=False, action='store_true')
+   parser.add_option('-S', '--stream', dest='stream', action='store_true',
+                     help='Print instances as they arrive using pull enumeration',
+                     default=False)
+   parser.add_option('-b', '--batch-size', dest='batchSize', type='int', default=100,
+                     help='Instances per pull request with --stream (default is 100)')
+   parser.add_option('-P', '--properties', dest='properties',
+                     help='Comma separated list of properties to fetch with --stream')
+
+   parser.add_option('-I', '--incremental', dest='incremental', action='store_true',
+                     help='Only print SEL records not seen on an earlier run', default=False)
+   parser.add_option('-a', '--archive', dest='archive',
+                     help='Append the new SEL records to this file with --incremental')
+   parser.add_option('-H', '--hosts', dest='hosts',
+                     help='Comma separated hosts, or @file, to poll with --interval')
+   parser.add_option('-i', '--interval', dest='interval', type='int',
+                     help='Keep polling the health of the hosts every INTERVAL seconds')
+   parser.add_option('-w', '--workers', dest='workers', type='int', default=4,
+                     help='Number of hosts polled at the same time (default is 4)')
+   parser.add_option('-j', '--jitter', dest='jitter', type='float',
+                     help='Random delay in seconds added to each poll (default is 10% of interval)')
+   parser.add_option('-m', '--metrics', dest='metrics',
+                     help='Serve Prometheus metrics of the latest polls on HOST:PORT/metrics')
+   parser.add_option('-J', '--json-lines', dest='jsonLines',
+                     help='Append the samples of every poll as JSON lines to this file (- for stdout)')
+
+   parser.add_option('-T', '--timeout', dest='timeout', type='int', default=60,
+                     help='Seconds a CIM operation may take before the poll fails (default is 60)')
+   parser.add_option('-t', '--timing', dest='timing', action='store_true', default=False,
+                     help='Print the time spent in each CIM operation per host')
 
    (options, args) = parser.parse_args()
-   if options.server is None:
+   if options.server is None and options.hosts is None:
       print 'You must specify a server to connect to.  Use --help for usage'
       sys.exit(1)
+   if options.hosts and not options.interval:
+      parser.error('--hosts needs --interval')
+   if (options.metrics or options.jsonLines) and not options.interval:
+      parser.error('--metrics and --json-lines need --interval')
+   if options.timeout <= 0:
+      parser.error('--timeout must be positive')
+   connections.timeout = options.timeout
    if options.username is None:
       options.username = 'root'
    if options.password is None:
       options.password = ''
 
+   if options.interval:
+      if options.metrics:
+         startMetricsServer(options.metrics)
+      if options.jsonLines == '-':
+         jsonLinesFile = sys.stdout
+      elif options.jsonLines:
+         jsonLinesFile = open(options.jsonLines, 'a')
+      if options.hosts:
+         hosts = getHostList(options.hosts)
+      else:
+         hosts = [options.server]
+      if options.jitter is None:
+         options.jitter = options.interval * 0.1
+      try:
+         pollHosts(hosts, options.username, options.password, options.interval,
+                   options.workers, options.jitter)
+      except KeyboardInterrupt:
+         pass
+      if options.timing:
+         connections.printTimings()
+      sys.exit(0)
+
    if options.namespaceonly is True:
       for namespace in getNamespaces(options):
          print '%s' % namespace
+      if options.timing:
+         connections.printTimings()
       sys.exit(0)
 
-   client = pywbem.WBEMConnection('https://'+options.server,
-                                  (options.username, options.password),
-                                  options.namespace)
+   propertyList = None
+   if options.properties:
+      propertyList = [p.strip() for p in options.properties.split(',')]
+
+   archive = None
+   if options.archive:
+      archive = open(options.archive, 'a')
 
-   dumpAssetInformation(options.server, options.username, options.password, options.clearSEL)
+   dumpAssetInformation(options.server, options.username, options.password, options.clearSEL,
+                        options.stream, options.batchSize, propertyList,
+                        options.incremental, archive, options.namespace)
+   if archive:
+      archive.close()
+   saveValueMaps()
+   if options.timing:
+      connections.printTimings()